@@ -0,0 +1,46 @@
+import tempfile
+
+from pathlib import Path
+from volcsarvatory import aoi
+from volcsarvatory.cache import update_json_cache
+
+from . import synthetic
+
+
+def timeraw_import_aoi():
+    """
+    Time to import volcsarvatory.aoi in a new interpreter.
+    """
+    return "from volcsarvatory import aoi"
+
+
+class BurstIds:
+    """
+    Burst discovery for areas of interest against a synthetic local S1 catalog.
+    """
+    params = [1, 10, 100]
+    param_names = ['num_aois']
+
+    def setup(self, num_aois):
+        self.tempdir = tempfile.TemporaryDirectory()
+        folder = Path(self.tempdir.name)
+        self.s1_catalog = aoi.S1_CATALOG
+        aoi.S1_CATALOG = folder / 's1_frames.parquet'
+        synthetic.write_burst_catalog(synthetic.make_burst_catalog(), aoi.S1_CATALOG)
+        update_json_cache(aoi.S1_CATALOG.with_suffix('.json'), {'version': 'synthetic'})
+        self.aoi_file = folder / 'aoi.parquet'
+        synthetic.make_aois(num_aois).to_parquet(self.aoi_file)
+        self.search = synthetic.available_search
+
+    def teardown(self, num_aois):
+        aoi.S1_CATALOG = self.s1_catalog
+        self.tempdir.cleanup()
+
+    def time_get_burst_ids(self, num_aois):
+        aoi.get_burst_ids(aoi_file=self.aoi_file, search=self.search, cache_file=None)
+
+    def peakmem_get_burst_ids(self, num_aois):
+        aoi.get_burst_ids(aoi_file=self.aoi_file, search=self.search, cache_file=None)
+
+    def time_get_burst_ids_single(self, num_aois):
+        aoi.get_burst_ids('aoi_0', aoi_file=self.aoi_file, search=self.search, cache_file=None)
@@ -0,0 +1,28 @@
+from volcsarvatory import prepare_multibursts as pm
+from volcsarvatory.simulation import FixtureMultiBurst
+
+from . import synthetic
+
+
+class SplitMultibursts:
+    """
+    Splitting of the multiburst set of one path into valid sets.
+    """
+    params = [[30, 120, 480], ['dense', 'holes', 'staggered']]
+    param_names = ['num_bursts', 'pattern']
+
+    def setup(self, num_bursts, pattern):
+        self.multiburst_dict = synthetic.make_multiburst(num_bursts, pattern)
+        self.burst_ids = [f'{bid}_{swath}' for bid, swaths in self.multiburst_dict.items() for swath in swaths]
+
+    def time_split_multiburst(self, num_bursts, pattern):
+        pm.split_multiburst(self.multiburst_dict)
+
+    def time_plan_multiburst(self, num_bursts, pattern):
+        pm.plan_multiburst(self.multiburst_dict)
+
+    def peakmem_plan_multiburst(self, num_bursts, pattern):
+        pm.plan_multiburst(self.multiburst_dict)
+
+    def time_get_multibursts_path(self, num_bursts, pattern):
+        pm.get_multibursts_path(self.burst_ids, multiburst_class=FixtureMultiBurst, use_cache=False)
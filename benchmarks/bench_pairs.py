@@ -0,0 +1,39 @@
+import shutil
+import tempfile
+
+from pathlib import Path
+from volcsarvatory import pairs
+
+from . import synthetic
+
+
+class SameFrame:
+    """
+    Reprojection and subsetting of synthetic HyP3 products to a common frame.
+    """
+    params = [[10, 50], ['single', 'vrt', 'steps']]
+    param_names = ['num_pairs', 'mode']
+    number = 1
+    repeat = 3
+    warmup_time = 0
+    timeout = 600
+
+    def setup_cache(self):
+        folder = Path('hyp3_products')
+        for num_pairs in self.params[0]:
+            synthetic.make_hyp3_products(folder / str(num_pairs), num_pairs)
+        return str(folder.resolve())
+
+    def setup(self, products, num_pairs, mode):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.folder = Path(self.tempdir.name) / 'products'
+        shutil.copytree(Path(products) / str(num_pairs), self.folder)
+
+    def teardown(self, products, num_pairs, mode):
+        self.tempdir.cleanup()
+
+    def time_set_same_frame(self, products, num_pairs, mode):
+        pairs.set_same_frame(self.folder, mode=mode)
+
+    def peakmem_set_same_frame(self, products, num_pairs, mode):
+        pairs.set_same_frame(self.folder, mode=mode)
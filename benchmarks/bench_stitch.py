@@ -0,0 +1,82 @@
+import h5py
+import tempfile
+
+from datetime import datetime, timedelta
+from pathlib import Path
+from volcsarvatory import stitch_ts
+
+from . import synthetic
+
+
+class Timeseries:
+    """
+    Re-referencing and merging of synthetic MintPy timeseries.
+    """
+    params = [[(50, 250, 250), (200, 1000, 1000)], [None, (1, 128, 128)]]
+    param_names = ['shape', 'chunks']
+    timeout = 600
+
+    def setup(self, shape, chunks):
+        num_dates, length, width = shape
+        self.tempdir = tempfile.TemporaryDirectory()
+        folder = Path(self.tempdir.name)
+        self.reference = folder / 'reference.h5'
+        self.secondary = folder / 'secondary.h5'
+        self.out_file = folder / 'merged.h5'
+        synthetic.make_timeseries(self.reference, num_dates, length, width, chunks=chunks)
+        synthetic.make_timeseries(self.secondary, num_dates, length, width, x_first=-155.5 + 0.0008*width/4,
+                                  y_first=19.7 - 0.0008*length/4, first_date=datetime(2020, 1, 1) + timedelta(days=12*(num_dates//2)), chunks=chunks, seed=1)
+        self.ref_coords = (-155.5 + 0.0008*width/2, 19.7 - 0.0008*length/2)
+
+    def teardown(self, shape, chunks):
+        self.tempdir.cleanup()
+
+    def time_change_reference(self, shape, chunks):
+        stitch_ts.change_reference(self.reference, self.ref_coords)
+
+    def peakmem_change_reference(self, shape, chunks):
+        stitch_ts.change_reference(self.reference, self.ref_coords)
+
+    def time_merge_timeseries(self, shape, chunks):
+        stitch_ts.merge_timeseries(self.reference, self.secondary, self.out_file)
+
+    def peakmem_merge_timeseries(self, shape, chunks):
+        stitch_ts.merge_timeseries(self.reference, self.secondary, self.out_file)
+
+
+
+class TimeseriesLayout:
+    """
+    Merging into and reading from chunked, compressed timeseries layouts.
+    """
+    params = [[None, (None, 64, 64)], [None, 'lzf', 'gzip']]
+    param_names = ['chunks', 'compression']
+    timeout = 600
+
+    def setup(self, chunks, compression):
+        self.tempdir = tempfile.TemporaryDirectory()
+        folder = Path(self.tempdir.name)
+        self.reference = folder / 'reference.h5'
+        self.secondary = folder / 'secondary.h5'
+        self.out_file = folder / 'merged.h5'
+        synthetic.make_timeseries(self.reference, 100, 500, 500)
+        synthetic.make_timeseries(self.secondary, 100, 500, 500, first_date=datetime(2020, 1, 1) + timedelta(days=12*50), seed=1)
+        stitch_ts.merge_timeseries(self.reference, self.secondary, self.out_file, chunks=chunks, compression=compression)
+
+    def teardown(self, chunks, compression):
+        self.tempdir.cleanup()
+
+    def time_merge_timeseries(self, chunks, compression):
+        stitch_ts.merge_timeseries(self.reference, self.secondary, self.out_file, chunks=chunks, compression=compression)
+
+    def time_read_points(self, chunks, compression):
+        with h5py.File(self.out_file) as h5f:
+            for i in range(100):
+                h5f['timeseries'][:, (7*i) % 500, (13*i) % 500]
+
+    def time_read_tile(self, chunks, compression):
+        with h5py.File(self.out_file) as h5f:
+            h5f['timeseries'][:, 128:192, 256:320]
+
+    def track_file_size(self, chunks, compression):
+        return self.out_file.stat().st_size
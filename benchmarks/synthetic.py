@@ -0,0 +1,169 @@
+"""
+Generators of synthetic inputs for the benchmarks, so they run without network access.
+"""
+import geopandas as gpd
+import h5py
+import numpy as np
+import rasterio
+
+from datetime import datetime, timedelta
+from pyproj import Transformer
+from rasterio.transform import from_origin
+from shapely.geometry import box
+from volcsarvatory.prepare_multibursts import grid_to_multiburst
+from volcsarvatory.simulation import FixtureProduct
+
+
+def make_burst_catalog(num_paths = 10, num_bursts = 250, lon = -156.5, lat = 18.0):
+    """
+    Makes a catalog of S1 bursts like the ITS_LIVE mission frames.
+
+    Args:
+        num_paths: Number of relative orbits.
+        num_bursts: Number of bursts per swath and path.
+        lon: Longitude of the first burst.
+        lat: Latitude of the first burst.
+
+    Returns:
+        catalog: Geopandas dataframe with the columns 'id', 'mission' and 'geometry'.
+    """
+    ids = []
+    geometries = []
+    for path in range(num_paths):
+        for burst in range(num_bursts):
+            for swath in range(3):
+                minlon = lon + 0.8*path + 0.35*swath
+                minlat = lat + 0.18*burst
+                ids.append(f'{path + 1:03d}_{300000 + burst:06d}_IW{swath + 1}')
+                geometries.append(box(minlon, minlat, minlon + 0.4, minlat + 0.2))
+    return gpd.GeoDataFrame({'id': ids, 'mission': 'S1', 'geometry': geometries}, crs='EPSG:4326')
+
+
+def write_burst_catalog(catalog, path):
+    """
+    Writes a burst catalog like aoi.update_s1_catalog does.
+
+    Args:
+        catalog: Geopandas dataframe with the bursts.
+        path: Path to the GeoParquet file.
+    """
+    catalog = catalog.iloc[catalog.hilbert_distance().argsort()]
+    catalog.to_parquet(path, write_covering_bbox=True, row_group_size=10000)
+
+
+def make_aois(num_aois = 10, bounds = (-156.5, 18.0, -148.0, 63.0), size = 0.5, seed = 0):
+    """
+    Makes random square areas of interest.
+
+    Args:
+        num_aois: Number of areas of interest.
+        bounds: Bounding box (minlon, minlat, maxlon, maxlat) where the areas of interest are placed.
+        size: Side of the areas of interest in degrees.
+        seed: Seed of the random generator.
+
+    Returns:
+        aois: Geopandas dataframe with the columns 'name' and 'geometry'.
+    """
+    rng = np.random.default_rng(seed)
+    lons = rng.uniform(bounds[0], bounds[2] - size, num_aois)
+    lats = rng.uniform(bounds[1], bounds[3] - size, num_aois)
+    geometries = [box(lon, lat, lon + size, lat + size) for lon, lat in zip(lons, lats)]
+    return gpd.GeoDataFrame({'name': [f'aoi_{i}' for i in range(num_aois)], 'geometry': geometries}, crs='EPSG:4326')
+
+
+def available_search(fullBurstID, **kwargs):
+    """
+    Stand-in for asf_search.search where every burst has two acquisitions.
+    """
+    return [FixtureProduct({'stopTime': '2020-01-13T00:00:00Z'}), FixtureProduct({'stopTime': '2020-01-01T00:00:00Z'})]
+
+
+def make_multiburst(num_bursts = 60, pattern = 'dense', seed = 0):
+    """
+    Makes the multiburst set of a path with an occupancy pattern.
+
+    Args:
+        num_bursts: Number of burst numbers along the path.
+        pattern: 'dense' (all swaths), 'holes' (random missing bursts) or 'staggered' (swaths with shifted ranges).
+        seed: Seed of the random generator.
+
+    Returns:
+        multiburst_dict: Dictionary where the keys are burst IDs and the elements are the swaths.
+    """
+    rng = np.random.default_rng(seed)
+    occupancy = np.ones((num_bursts, 3), dtype=bool)
+    if pattern == 'holes':
+        occupancy = rng.random((num_bursts, 3)) < 0.85
+    elif pattern == 'staggered':
+        for swath in range(3):
+            start, end = sorted(rng.integers(0, num_bursts, 2))
+            occupancy[:start, swath] = False
+            occupancy[end + 1:, swath] = False
+    occupancy[0, 0] = True
+    return grid_to_multiburst(('064', 300000, occupancy))
+
+
+def make_timeseries(path, num_dates = 100, length = 500, width = 500, x_first = -155.5, y_first = 19.7,
+                    step = 0.0008, first_date = datetime(2020, 1, 1), chunks = None, seed = 0):
+    """
+    Writes a MintPy timeseries file with random displacements.
+
+    Args:
+        path: Path to the H5 file.
+        num_dates: Number of epochs.
+        length: Number of rows.
+        width: Number of columns.
+        x_first: Longitude of the upper left corner.
+        y_first: Latitude of the upper left corner.
+        step: Pixel size in degrees.
+        first_date: Date of the first epoch. Epochs are every 12 days.
+        chunks: Chunk shape of the timeseries dataset. If None it is contiguous.
+        seed: Seed of the random generator.
+    """
+    rng = np.random.default_rng(seed)
+    dates = [(first_date + timedelta(days=12*i)).strftime('%Y%m%d') for i in range(num_dates)]
+    with h5py.File(path, 'w') as h5f:
+        timeseries = h5f.create_dataset('timeseries', shape=(num_dates, length, width), dtype=np.float32, chunks=chunks)
+        for t in range(num_dates):
+            timeseries[t] = rng.normal(scale=0.01, size=(length, width)).astype(np.float32)
+        h5f.create_dataset('date', data=np.array(dates, dtype='S8'))
+        h5f.create_dataset('bperp', data=np.zeros(num_dates, dtype=np.float32))
+        h5f.attrs.update({
+            'FILE_TYPE': 'timeseries', 'X_FIRST': str(x_first), 'Y_FIRST': str(y_first),
+            'X_STEP': str(step), 'Y_STEP': str(-step), 'LENGTH': str(length), 'WIDTH': str(width),
+            'REF_Y': length//2, 'REF_X': width//2, 'REF_DATE': dates[0], 'START_DATE': dates[0], 'END_DATE': dates[-1],
+        })
+
+
+def make_hyp3_products(folder, num_pairs = 10, size = 500, res = 80, epsgs = (32605, 32604), seed = 0):
+    """
+    Writes a folder of HyP3 multiburst products renamed to MintPy standards.
+
+    The pairs are split between the EPSG codes and cover the same area with small shifts.
+
+    Args:
+        folder: Path to the folder.
+        num_pairs: Number of pairs.
+        size: Number of rows and columns of the rasters.
+        res: Pixel size in meters.
+        epsgs: EPSG codes of the products.
+        seed: Seed of the random generator.
+    """
+    rng = np.random.default_rng(seed)
+    layers = {'dem': 'float32', 'lv_phi': 'float32', 'lv_theta': 'float32', 'water_mask': 'uint8',
+              'unw_phase': 'float32', 'corr': 'float32', 'conncomp': 'int16'}
+    for i in range(num_pairs):
+        epsg = epsgs[i % len(epsgs)]
+        transformer = Transformer.from_crs('EPSG:4326', f'EPSG:{epsg}', always_xy=True)
+        x, y = transformer.transform(-155.5, 19.7)
+        x = float(round(x / res) * res + res * rng.integers(-5, 5))
+        y = float(round(y / res) * res + res * rng.integers(-5, 5))
+        name = f'S1_064_300000s1n00-300010s3n02_IW_{20200101 + i:08d}_{20200113 + i:08d}_VV_INT80_{i:04X}'
+        pair_folder = folder / name
+        pair_folder.mkdir(parents=True, exist_ok=True)
+        for layer, dtype in layers.items():
+            data = rng.random((size, size)).astype(dtype) if dtype == 'float32' else np.ones((size, size), dtype=dtype)
+            profile = {'driver': 'GTiff', 'height': size, 'width': size, 'count': 1, 'dtype': dtype,
+                       'crs': f'EPSG:{epsg}', 'transform': from_origin(x, y, res, res)}
+            with rasterio.open(pair_folder / f'{name}_{layer}.tif', 'w', **profile) as dst:
+                dst.write(data, 1)
@@ -0,0 +1,70 @@
+from hyp3_sdk import Batch
+from volcsarvatory import pairs
+from volcsarvatory.cache import update_json_cache
+from volcsarvatory.simulation import FixtureHyP3, FixtureJob
+
+
+def prepare_jobs(hyp3, num_jobs, name = 'project'):
+    return [hyp3.prepare_insar_isce_multi_burst_job([f'reference_{i}'], [f'secondary_{i}'], name=name) for i in range(num_jobs)]
+
+
+def test_submit_jobs_batches():
+    hyp3 = FixtureHyP3()
+    jobs = pairs.submit_jobs(prepare_jobs(hyp3, 200), hyp3, batch_size=100)
+    assert [len(batch) for batch in jobs] == [100, 100]
+    assert all(isinstance(batch, Batch) for batch in jobs)
+    assert len(hyp3.submitted) == 200
+
+
+def test_submit_jobs_lost_response():
+    hyp3 = FixtureHyP3(failures=1, lost_responses=2)
+    jobs = pairs.submit_jobs(prepare_jobs(hyp3, 250), hyp3, batch_size=100, backoff=0)
+    assert sum(len(batch) for batch in jobs) == 250
+    assert len(hyp3.submitted) == len({job.job_id for job in hyp3.submitted}) == 250
+
+
+def test_submit_jobs_journal(tmp_path):
+    hyp3 = FixtureHyP3()
+    journal_file = tmp_path / 'journal.json'
+    insar_jobs = prepare_jobs(hyp3, 150)
+    pairs.submit_jobs(insar_jobs, hyp3, batch_size=100, journal_file=journal_file)
+    assert pairs.submit_jobs(insar_jobs, hyp3, batch_size=100, journal_file=journal_file) == []
+    assert len(hyp3.submitted) == 150
+
+
+def test_submit_jobs_in_flight(tmp_path):
+    hyp3 = FixtureHyP3()
+    journal_file = tmp_path / 'journal.json'
+    insar_jobs = prepare_jobs(hyp3, 2)
+    hyp3.submit_prepared_jobs(insar_jobs[:1])
+    keys = [pairs._get_job_key(job['job_type'], job['name'], job['job_parameters']) for job in insar_jobs]
+    update_json_cache(journal_file, {key: None for key in keys})
+    jobs = pairs.submit_jobs(insar_jobs, hyp3, journal_file=journal_file)
+    assert sum(len(batch) for batch in jobs) == 1
+    assert len(hyp3.submitted) == 2
+
+
+def test_submit_jobs_failed_job_resubmitted(tmp_path):
+    hyp3 = FixtureHyP3()
+    journal_file = tmp_path / 'journal.json'
+    insar_jobs = prepare_jobs(hyp3, 1)
+    job = insar_jobs[0]
+    hyp3.submitted.append(FixtureJob('failed', job['job_type'], job['job_parameters'], name=job['name'], status_code='FAILED'))
+    update_json_cache(journal_file, {pairs._get_job_key(job['job_type'], job['name'], job['job_parameters']): None})
+    jobs = pairs.submit_jobs(insar_jobs, hyp3, journal_file=journal_file)
+    assert sum(len(batch) for batch in jobs) == 1
+    assert jobs[0].jobs[0].job_id != 'failed'
+
+
+def test_update_network_failed_pairs(tmp_path):
+    hyp3 = FixtureHyP3()
+    record_file = tmp_path / 'network.json'
+    refs = [f'S1_000001_IW1_2020010{i}T000000_VV_0000-BURST' for i in range(1, 4)]
+    secs = [f'S1_000001_IW1_2020011{i}T000000_VV_0000-BURST' for i in range(1, 4)]
+    jobs = pairs.update_network(refs, secs, 'project', hyp3, record_file=record_file)
+    assert sum(len(batch) for batch in jobs) == 3
+    assert pairs.update_network(refs, secs, 'project', hyp3, record_file=record_file) == []
+
+    hyp3.submitted[0].status_code = 'FAILED'
+    jobs = pairs.update_network(refs, secs, 'project', hyp3, record_file=record_file)
+    assert [job.job_parameters['reference'] for batch in jobs for job in batch] == [hyp3.submitted[0].job_parameters['reference']]
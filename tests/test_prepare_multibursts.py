@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from volcsarvatory import prepare_multibursts as pm
+
+
+def random_grids(num_grids = 200, max_rows = 40, seed = 0):
+    rng = np.random.default_rng(seed)
+    for _ in range(num_grids):
+        rows = int(rng.integers(1, max_rows))
+        occupancy = rng.random((rows, 3)) < rng.uniform(0.2, 0.95)
+        occupancy[0, int(rng.integers(3))] = True
+        yield ('064', 300000, occupancy)
+
+
+def check_plan(grid, plan):
+    path, first, occupancy = grid
+    covered = np.zeros_like(occupancy)
+    for multiburst_dict in plan['multiburst_dicts']:
+        plan_path, plan_first, plan_occupancy = pm.multiburst_to_grid(multiburst_dict)
+        assert plan_path == path
+        assert pm.is_valid_grid(plan_occupancy)
+        covered[plan_first - first:plan_first - first + plan_occupancy.shape[0]] |= plan_occupancy
+    assert np.all(covered[occupancy])
+
+
+@pytest.mark.parametrize('grid', list(random_grids()), ids=lambda grid: str(grid[2].shape[0]))
+def test_plan_multiburst(grid):
+    plans = {plan['name']: plan for plan in pm.plan_multiburst(pm.grid_to_multiburst(grid))}
+    for plan in plans.values():
+        check_plan(grid, plan)
+    assert plans['min_cost']['cost'] <= plans['heuristic']['cost']
+    assert plans['min_sets']['sets'] <= plans['heuristic']['sets']
+    assert plans['min_bursts']['bursts'] <= plans['heuristic']['bursts']
+
+
+def test_plan_multiburst_missing_middle_swath():
+    plans = {plan['name']: plan for plan in pm.plan_multiburst({'064_300000': ('IW1', 'IW3')})}
+    assert plans['min_sets']['sets'] == 1
+    assert plans['min_cost']['cost'] == plans['heuristic']['cost'] == 6
+    assert plans['min_bursts']['bursts'] == 2
@@ -1,19 +1,29 @@
 import asf_search as asf
-import cartopy.feature as cfeature
 import fsspec
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 import os
+import shapely
 import warnings
 
+from asf_search.exceptions import ASFSearch5xxError
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from shapely.geometry import Polygon
+from shapely.geometry import Polygon, box
+from volcsarvatory.cache import CACHE_DIR, load_json_cache, update_json_cache
+from volcsarvatory.retry import call_with_retries
 
 PARQUET_DIR = Path(__file__).parent / 'parquets'
 
-land_50m = cfeature.NaturalEarthFeature('physical','land','10m')
-land_polygons_cartopy = list(land_50m.geometries())
-land_gdf = gpd.GeoDataFrame(crs='epsg:4326', geometry=land_polygons_cartopy)
+LAND_CATALOG = CACHE_DIR / 'land_10m.parquet'
+LAND_TILE_SIZE = 10
+LAND_SIMPLIFY_TOLERANCE = 0.0001
+
+S1_CATALOG_URL = "s3://its-live-data/autorift_parameters/v001/mission_frames_all.parquet"
+S1_CATALOG = CACHE_DIR / 's1_frames.parquet'
+S1_CATALOG_CHECK_INTERVAL = 24*3600
+EQUAL_AREA_CRS = "EPSG:6933"
 
 s1_gdf = None
 
@@ -25,76 +35,304 @@ def get_aoi():
     aoigdf = aoigdf.to_crs("EPSG:4326")
     return aoigdf
 
-def add_aoi(id, extent):
+def get_land_gdf(bbox = None):
+    """
+    Loads the Natural Earth 10m land mask.
+    
+    The first call builds a local GeoParquet copy with the land polygons simplified and split in tiles of
+    LAND_TILE_SIZE degrees, so the next calls only read the tiles intersecting the bounding box.
+    
+    Args:
+        bbox: Bounding box (minlon, minlat, maxlon, maxlat). If None all the land mask is loaded.
+    
+    Returns:
+        land_gdf: Geopandas dataframe with the land polygons intersecting the bounding box.
+    """
+    if not LAND_CATALOG.exists():
+        import cartopy.feature as cfeature
+
+        land_10m = cfeature.NaturalEarthFeature('physical','land','10m')
+        land_gdf = gpd.GeoDataFrame(crs='epsg:4326', geometry=list(land_10m.geometries())).explode(index_parts=False)
+        land_gdf['geometry'] = land_gdf.simplify(LAND_SIMPLIFY_TOLERANCE)
+        tiles = [box(lon, lat, lon+LAND_TILE_SIZE, lat+LAND_TILE_SIZE)
+                 for lon in range(-180, 180, LAND_TILE_SIZE) for lat in range(-90, 90, LAND_TILE_SIZE)]
+        tiles_gdf = gpd.GeoDataFrame(crs='epsg:4326', geometry=tiles)
+        land_gdf = gpd.overlay(land_gdf, tiles_gdf, how='intersection', keep_geom_type=True)
+        land_gdf = land_gdf.iloc[land_gdf.hilbert_distance().argsort()]
+        LAND_CATALOG.parent.mkdir(parents=True, exist_ok=True)
+        temp = LAND_CATALOG.with_name(f'.{LAND_CATALOG.name}.{os.getpid()}')
+        land_gdf.to_parquet(temp, write_covering_bbox=True, row_group_size=1000)
+        os.replace(temp, LAND_CATALOG)
+    return gpd.read_parquet(LAND_CATALOG, bbox=bbox)
+
+def get_land_intersection(aoi_gdf):
+    """
+    Clips areas of interest to the land mask.
+    
+    Args:
+        aoi_gdf: Geopandas dataframe with the areas of interest, with a 'name' column.
+    
+    Returns:
+        intersection: Geopandas dataframe with one row per area of interest intersecting land.
+    """
+    land_gdf = get_land_gdf(bbox=tuple(aoi_gdf.total_bounds))
+    land_gdf = gpd.clip(land_gdf, aoi_gdf.total_bounds)
+    intersection = gpd.overlay(aoi_gdf, land_gdf, how='intersection')
+    intersection = intersection.dissolve(by='name', as_index=False)
+    return intersection
+
+def add_aois(aois, aoi_file = None):
+    """
+    Adds or replaces several areas of interest in the parquet file with one write.
+    
+    Only the new areas of interest are clipped to the land mask, the rest are kept as stored.
+    
+    Args:
+        aois: Dictionary where the keys are the ids and the elements are lists of lon/lat coordinates in the format
+              [minlon, maxlon, minlat, maxlat], or Geopandas dataframe with the ids in a 'name' column.
+        aoi_file: Path to the parquet file. If None it takes the parquet file in cache.
+    
+    Returns:
+        aoi_gdf: Geopandas dataframe with all the areas of interest intersected with the land mask.
+    """
+    if aoi_file is None:
+        aoi_file = f"{PARQUET_DIR}/aoi_vol.parquet"
+    if isinstance(aois, gpd.GeoDataFrame):
+        new_aoi = aois[['name', 'geometry']].to_crs("EPSG:4326")
+    else:
+        polys = []
+        for minlon, maxlon, minlat, maxlat in aois.values():
+            polys.append(Polygon([(minlon,maxlat,0),(minlon,minlat,0),(maxlon,minlat,0),(maxlon,maxlat,0)]))
+        new_aoi = gpd.GeoDataFrame({'name': list(aois.keys()), 'geometry': polys}, crs="EPSG:4326")
+    intersection = get_land_intersection(new_aoi)
+    if os.path.exists(aoi_file):
+        aoi_gdf = gpd.read_parquet(aoi_file)
+        replaced = aoi_gdf['name'].isin(new_aoi['name'])
+        if replaced.any():
+            warnings.warn(f'AOIs with the same ID exist in the dataframe: {", ".join(aoi_gdf[replaced]["name"])}. Replacing...', UserWarning)
+        aoi_gdf = pd.concat([aoi_gdf[~replaced], intersection], ignore_index=True)
+    else:
+        aoi_gdf = intersection
+    aoi_gdf.to_parquet(aoi_file)
+
+    return aoi_gdf
+
+def add_aoi(id, extent, aoi_file = None):
     """
     Adds or replaces an area of interest in the parquet file.
     
     Args:
         id: Id for the area of interest.
         extent: List of lon/lat coordinates for the area of interest in the format [minlon, maxlon, minlat, maxlat].
+        aoi_file: Path to the parquet file. If None it takes the parquet file in cache.
     
     Returns:
-        intersection: Geopandas dataframe with the intersection between the area of interest and the land mask. 
-    """
-    ullon, lrlon, lrlat, ullat = extent
-    poly=Polygon([(ullon,ullat,0),(ullon,lrlat,0),(lrlon,lrlat,0),(lrlon,ullat,0)])
-    new_aoi = {'name': [id], 'geometry': [poly]}
-    new_aoi = gpd.GeoDataFrame(new_aoi, crs="EPSG:4326")
-    if os.path.exists(f"{PARQUET_DIR}/aoi_vol.parquet"):
-        aoi_gdf = gpd.read_parquet(f"{PARQUET_DIR}/aoi_vol.parquet")
-        if len(aoi_gdf[aoi_gdf['name'] == id]) > 0:
-            warnings.warn('An AOI with the same ID exists in the dataframe. Replacing...', UserWarning)
-            aoi_gdf[aoi_gdf['name'] == id]['geometry'] = poly
-        else:
-            aoi_gdf = pd.concat([aoi_gdf, new_aoi], ignore_index=True)
-    else:
-        aoi_gdf = new_aoi
-    intersection = gpd.overlay(aoi_gdf, land_gdf, how='intersection')
-    intersection.to_parquet(f"{PARQUET_DIR}/aoi_vol.parquet")
+        aoi_gdf: Geopandas dataframe with all the areas of interest in the parquet file, including the new one
+                 intersected with the land mask.
+    """
+    return add_aois({id: extent}, aoi_file=aoi_file)
 
-    return intersection
+def find_aois(point = None, bbox = None, aoi_file = None):
+    """
+    Finds the areas of interest that contain a point or intersect a bounding box.
+    
+    Args:
+        point: Tuple with lon/lat coordinates.
+        bbox: Bounding box (minlon, minlat, maxlon, maxlat).
+        aoi_file: Path to the parquet file. If None it takes the parquet file in cache.
+    
+    Returns:
+        aoi_gdf: Geopandas dataframe with the areas of interest found.
+    """
+    if aoi_file is None:
+        aoi_file = f"{PARQUET_DIR}/aoi_vol.parquet"
+    if point is not None:
+        bbox = (point[0], point[1], point[0], point[1])
+    aoi_gdf = gpd.read_parquet(aoi_file)
+    index = aoi_gdf.sindex.query(box(*bbox), predicate='intersects')
+    return aoi_gdf.iloc[sorted(index)]
 
-def load_s1_gdf():
+def update_s1_catalog(force = False):
+    """
+    Keeps a local copy of the S1 frames from the ITS_LIVE parquet file.
+    
+    The local copy is filtered to S1, sorted spatially and written as a GeoParquet file with bbox statistics, so
+    it can be read by bounding box. The remote version (ETag) is checked at most once per S1_CATALOG_CHECK_INTERVAL,
+    and the local copy is used if the remote file can't be reached, until the next check.
+    
+    Args:
+        force: If True it downloads the file even if the local copy is up to date.
+    
+    Returns:
+        catalog: Path to the local copy.
+    """
+    version_file = S1_CATALOG.with_suffix('.json')
+    if S1_CATALOG.exists() and not force and 'version' in load_json_cache(version_file, ttl=S1_CATALOG_CHECK_INTERVAL):
+        return S1_CATALOG
+    fs = fsspec.filesystem("s3", anon=True, config_kwargs={'connect_timeout': 5, 'retries': {'max_attempts': 2}})
+    try:
+        info = fs.info(S1_CATALOG_URL)
+        version = str(info.get('ETag', info.get('LastModified')))
+    except Exception as e:
+        if not S1_CATALOG.exists():
+            raise
+        warnings.warn(f'Could not check the version of the S1 frames ({e}). Using the local copy.', UserWarning)
+        # defer the next check one interval, so calls without network don't wait for the timeout each time
+        update_json_cache(version_file, {'version': load_json_cache(version_file).get('version')})
+        return S1_CATALOG
+    if S1_CATALOG.exists() and not force and load_json_cache(version_file).get('version') == version:
+        update_json_cache(version_file, {'version': version})
+        return S1_CATALOG
+    print(f'Downloading S1 frames to {S1_CATALOG}')
+    gdf = gpd.read_parquet(S1_CATALOG_URL, filesystem=fs)
+    gdf = gdf[(gdf['mission']=='S1')].to_crs("EPSG:4326")
+    gdf = gdf.iloc[gdf.hilbert_distance().argsort()]
+    S1_CATALOG.parent.mkdir(parents=True, exist_ok=True)
+    temp = S1_CATALOG.with_name(f'.{S1_CATALOG.name}.{os.getpid()}')
+    gdf.to_parquet(temp, write_covering_bbox=True, row_group_size=10000)
+    os.replace(temp, S1_CATALOG)
+    update_json_cache(version_file, {'version': version})
+    return S1_CATALOG
+
+def load_s1_gdf(bbox = None):
     """
     Loads a parquet file with the burst ids and the extents.
+    
+    Args:
+        bbox: Bounding box (minlon, minlat, maxlon, maxlat). If None all the bursts are loaded.
+    
+    Returns:
+        s1_gdf: Geopandas dataframe with the S1 bursts intersecting the bounding box.
     """
-    s3_url = "s3://its-live-data/autorift_parameters/v001/mission_frames_all.parquet"
-    fs = fsspec.filesystem("s3", anon=True)
-    gdf = gpd.read_parquet(s3_url, filesystem=fs)
+    gdf = gpd.read_parquet(update_s1_catalog(), bbox=bbox)
     global s1_gdf
-    s1_gdf = gdf[(gdf['mission']=='S1')]
+    s1_gdf = gdf
+    return s1_gdf
 
-def get_burst_ids(aoi_id = None, aoi_file = None):
+def is_burst_available(bid, search = asf.search):
+    """
+    Checks if a burst id has acquisitions available to make pairs.
+    
+    Args:
+        bid: Full burst id.
+        search: Search function with the same interface as asf_search.search.
+    
+    Returns:
+        available: True if the burst has more than one acquisition or a finished one.
+    """
+    asf_res = call_with_retries(search, fullBurstID=bid, exceptions=(ConnectionError, OSError, ASFSearch5xxError))
+    if len(asf_res)>1:
+        return True
+    elif len(asf_res)==1:
+        return asf_res[0].properties['stopTime'] is not None
+    return False
+
+def get_available_bursts(burst_ids, search = asf.search, max_workers = 8, cache_file = CACHE_DIR / 'burst_availability.json', cache_ttl = 7*24*3600):
+    """
+    Checks concurrently if the burst ids have acquisitions available.
+    
+    Args:
+        burst_ids: List of full burst ids.
+        search: Search function with the same interface as asf_search.search.
+        max_workers: Maximum number of concurrent searches.
+        cache_file: Path to the JSON file that caches the availability. If None the availability isn't cached.
+        cache_ttl: Time in seconds before a cached availability expires.
+    
+    Returns:
+        available: Dictionary where the keys are the burst ids and the elements are True if the burst is available.
+    """
+    available = dict()
+    if cache_file is not None:
+        cache = load_json_cache(cache_file, ttl=cache_ttl)
+        available = {bid: cache[bid] for bid in burst_ids if bid in cache.keys()}
+    missing = [bid for bid in burst_ids if bid not in available.keys()]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        checked = dict(zip(missing, executor.map(lambda bid: is_burst_available(bid, search), missing)))
+    if cache_file is not None and len(checked) > 0:
+        update_json_cache(cache_file, checked)
+    available.update(checked)
+    return available
+
+def get_burst_overlaps(bursts_gdf, aoi_gdf):
+    """
+    Computes the fraction of each burst covered by each area of interest with one spatial join.
+    
+    Areas are computed in an equal-area projection (EQUAL_AREA_CRS), and the intersection is only computed
+    for the bursts that are not fully inside the area of interest.
+    
+    Args:
+        bursts_gdf: Geopandas dataframe with the bursts, with an 'id' column.
+        aoi_gdf: Geopandas dataframe with the areas of interest, with a 'name' column.
+    
+    Returns:
+        overlaps: Dataframe with one row per intersecting burst and area of interest, with the columns
+                  'id', 'name' and 'overlap' (fraction of the burst area inside the area of interest).
+    """
+    aoi_gdf = aoi_gdf[['name', 'geometry']].to_crs(bursts_gdf.crs).reset_index(drop=True)
+    joined = gpd.sjoin(bursts_gdf[['id', 'geometry']], aoi_gdf, how='inner', predicate='intersects')
+    aoi_geoms = np.asarray(aoi_gdf.geometry.to_crs(EQUAL_AREA_CRS).values)
+    shapely.prepare(aoi_geoms)
+    aoi_geoms = aoi_geoms[joined['index_right'].to_numpy()]
+    burst_geoms = np.asarray(joined.geometry.to_crs(EQUAL_AREA_CRS).values)
+    overlap = np.ones(len(joined))
+    partial = ~shapely.contains_properly(aoi_geoms, burst_geoms)
+    overlap[partial] = shapely.area(shapely.intersection(burst_geoms[partial], aoi_geoms[partial])) / shapely.area(burst_geoms[partial])
+    joined['overlap'] = overlap
+    return pd.DataFrame(joined[['id', 'name', 'overlap']]).reset_index(drop=True)
+
+def get_bursts(aoi_ids = None, aoi_file = None, min_overlap = 0.05, check_availability = True, search = asf.search, max_workers = 8, cache_file = CACHE_DIR / 'burst_availability.json', cache_ttl = 7*24*3600):
+    """
+    Get the bursts that overlap several areas of interest.
+    
+    Args:
+        aoi_ids: List of ids for the areas of interest. If None all the area of interest are taken.
+        aoi_file: Path to the parquet file. If None it takes the parquet file in cache.
+        min_overlap: Minimum fraction of the burst area inside an area of interest.
+        check_availability: If True it only keeps the bursts with acquisitions available.
+        search: Search function with the same interface as asf_search.search.
+        max_workers: Maximum number of concurrent searches to check the availability of the bursts.
+        cache_file: Path to the JSON file that caches the availability. If None the availability isn't cached.
+        cache_ttl: Time in seconds before a cached availability expires.
+    
+    Returns:
+        overlaps: Dataframe with one row per burst and area of interest, with the columns 'id', 'name' and 'overlap'.
+                  Bursts overlapping any of the requested areas of interest are listed with all their areas of interest.
+    """
+    if aoi_file is None:
+        aoi_file = f"{PARQUET_DIR}/aoi_vol.parquet"
+    aoi_gdf = gpd.read_parquet(aoi_file).to_crs("EPSG:4326")
+    if aoi_ids is None:
+        aoi_ids = aoi_gdf['name'].to_list()
+    requested = aoi_gdf[aoi_gdf['name'].isin(aoi_ids)]
+    if len(requested) == 0:
+        return pd.DataFrame(columns=['id', 'name', 'overlap'])
+    load_s1_gdf(bbox=tuple(requested.total_bounds))
+    overlaps = get_burst_overlaps(s1_gdf, aoi_gdf)
+    overlaps = overlaps[overlaps['overlap'] > min_overlap]
+    overlaps = overlaps[overlaps['id'].isin(overlaps.loc[overlaps['name'].isin(aoi_ids), 'id'])]
+    if check_availability:
+        available = get_available_bursts(list(overlaps['id'].unique()), search=search, max_workers=max_workers, cache_file=cache_file, cache_ttl=cache_ttl)
+        overlaps = overlaps[overlaps['id'].map(available).astype(bool)]
+    return overlaps.reset_index(drop=True)
+
+def get_burst_ids(aoi_id = None, aoi_file = None, search = asf.search, max_workers = 8, cache_file = CACHE_DIR / 'burst_availability.json', cache_ttl = 7*24*3600):
     """
     Get the burst ids that intersect the area of interest.
     
     Args:
         aoi_id: Id for the area of interest. If None all the area of interest are taken.
         aoi_file: Path to the parquet file. If None it takes the parquet file in cache.
+        search: Search function with the same interface as asf_search.search.
+        max_workers: Maximum number of concurrent searches to check the availability of the bursts.
+        cache_file: Path to the JSON file that caches the availability. If None the availability isn't cached.
+        cache_ttl: Time in seconds before a cached availability expires.
     
     Returns:
         result: Dictionary where the keys are the burst ids and the area of interests overlapping.
     """
-    load_s1_gdf()
-    if aoi_file is None:
-        aoi_file = f"{PARQUET_DIR}/aoi_vol.parquet"
-    aoi_gdf = gpd.read_parquet(aoi_file)
-    bursts_gdf = gpd.sjoin(s1_gdf, aoi_gdf, how='inner', predicate='intersects')
-    bursts_gdf["area"] = gpd.overlay(s1_gdf, aoi_gdf, how='intersection').area.to_numpy()/bursts_gdf.area.to_numpy()
+    aoi_ids = None if aoi_id is None else [aoi_id]
+    overlaps = get_bursts(aoi_ids=aoi_ids, aoi_file=aoi_file, search=search, max_workers=max_workers, cache_file=cache_file, cache_ttl=cache_ttl)
     result = dict()
-    for bid in bursts_gdf["id"].unique():
-        asf_res=asf.search(fullBurstID=bid)
-        cond=False
-        if len(asf_res)>1:
-            cond=True
-        elif len(asf_res)==1:
-            if asf_res[0].properties['stopTime'] is not None:
-                cond=True
-        if cond:
-            if bursts_gdf[bursts_gdf["id"]==bid]["area"].to_numpy()[0] > 0.05:
-                if aoi_id is None:
-                    result[bid]=bursts_gdf[bursts_gdf["id"]==bid]["name"].unique()
-                else:
-                    if aoi_id in bursts_gdf[bursts_gdf["id"]==bid]["name"].unique():
-                        result[bid]=bursts_gdf[bursts_gdf["id"]==bid]["name"].unique()
+    for bid, names in overlaps.groupby("id", sort=False)["name"].unique().items():
+        result[bid] = names
     return result
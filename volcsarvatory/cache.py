@@ -0,0 +1,71 @@
+import json
+import os
+import time
+
+from pathlib import Path
+
+CACHE_DIR = Path(os.environ.get('VOLCSARVATORY_CACHE_DIR', Path.home() / '.cache' / 'volcsarvatory'))
+
+
+def load_json_cache(cache_file, ttl = None):
+    """
+    Reads the entries of a JSON cache file.
+    
+    Args:
+        cache_file: Path to the cache file.
+        ttl: Time to live of the entries in seconds. If None the entries never expire.
+    
+    Returns:
+        entries: Dictionary with the keys and values of the entries that have not expired.
+    """
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return dict()
+    now = time.time()
+    return {key: entry['value'] for key, entry in cache.items() if ttl is None or now - entry['time'] < ttl}
+
+def update_json_cache(cache_file, entries):
+    """
+    Adds or replaces entries in a JSON cache file.
+    
+    Args:
+        cache_file: Path to the cache file.
+        entries: Dictionary with the keys and values to store.
+    """
+    cache_file = Path(cache_file)
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        cache = dict()
+    now = time.time()
+    for key, value in entries.items():
+        cache[key] = {'value': value, 'time': now}
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    temp = cache_file.parent / f'.{cache_file.name}.{os.getpid()}'
+    with open(temp, 'w') as f:
+        json.dump(cache, f)
+    os.replace(temp, cache_file)
+
+def remove_json_cache(cache_file, keys):
+    """
+    Removes entries from a JSON cache file.
+    
+    Args:
+        cache_file: Path to the cache file.
+        keys: Keys of the entries to remove.
+    """
+    cache_file = Path(cache_file)
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return
+    for key in keys:
+        cache.pop(key, None)
+    temp = cache_file.parent / f'.{cache_file.name}.{os.getpid()}'
+    with open(temp, 'w') as f:
+        json.dump(cache, f)
+    os.replace(temp, cache_file)
@@ -0,0 +1,191 @@
+import asf_search as asf
+import geopandas as gpd
+import numpy as np
+import os
+import pandas as pd
+from asf_search.exceptions import ASFSearch5xxError
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from shapely.geometry import shape
+from volcsarvatory.cache import CACHE_DIR
+from volcsarvatory.retry import call_with_retries
+
+ATLAS_FILE = CACHE_DIR / 'coherence_atlas.parquet'
+ATLAS_COLUMNS = ['burst_id', 'baseline', 'ref_date', 'sec_date', 'doy', 'month', 'coherence']
+BASELINES = (6, 12, 18, 24, 36, 48)
+
+
+def search_burst(bid, search = asf.search, start = '2019-12-01', end = '2021-02-01'):
+    """
+    Searches the VV acquisitions of a burst.
+
+    Args:
+        bid: Full burst id.
+        search: Search function with the same interface as asf_search.search.
+        start: Start date of the search.
+        end: End date of the search.
+
+    Returns:
+        prods: List of products sorted from the oldest to the newest.
+    """
+    return call_with_retries(search, fullBurstID = bid, start = start, end = end, polarization = asf.POLARIZATION.VV,
+                             exceptions=(ConnectionError, OSError, ASFSearch5xxError))[::-1]
+
+def get_pair_candidates(prods, baselines = BASELINES):
+    """
+    Selects the pairs of acquisitions with the temporal baselines from the matrix of days between their dates.
+
+    Args:
+        prods: List of products sorted from the oldest to the newest.
+        baselines: Temporal baselines in days of the pairs.
+
+    Returns:
+        candidates: List of tuples (reference, secondary, baseline).
+    """
+    if len(prods) < 2:
+        return []
+    dates = np.array([prod.properties['startTime'][0:10] for prod in prods], dtype='datetime64[D]')
+    days = (dates[np.newaxis, :] - dates[:, np.newaxis]).astype(int)
+    refs, secs = np.nonzero(np.triu(np.isin(days, baselines), k=1))
+    return [(prods[i], prods[j], int(days[i, j])) for i, j in zip(refs, secs)]
+
+def estimate_pair_coherence(ref, sec, pair_class = asf.Pair):
+    """
+    Estimates the mean coherence of a pair.
+
+    Args:
+        ref: Reference product.
+        sec: Secondary product.
+        pair_class: Class with the same interface as asf_search.Pair.
+
+    Returns:
+        coherence: Mean coherence of the pair.
+    """
+    return call_with_retries(lambda: pair_class(ref, sec).estimate_s1_mean_coherence(), exceptions=(ConnectionError, OSError, ASFSearch5xxError))
+
+def _get_footprint(prod):
+    """
+    Gets the footprint of a product, or None if the product has no geometry.
+    """
+    geometry = getattr(prod, 'geometry', None)
+    return None if not geometry else shape(geometry)
+
+def load_atlas(burst_ids = None, baselines = None, atlas_file = ATLAS_FILE):
+    """
+    Reads the coherence estimates of several bursts from the coherence atlas.
+
+    Args:
+        burst_ids: List of full burst ids. If None all the bursts are read.
+        baselines: List of temporal baselines in days. If None all the baselines are read.
+        atlas_file: Path to the GeoParquet file with the coherence atlas.
+
+    Returns:
+        atlas: Geodataframe with one row per pair and the columns 'burst_id', 'baseline', 'ref_date', 'sec_date',
+               'doy' (day of year of the reference date), 'month', 'coherence' and 'geometry' (burst footprint).
+    """
+    if not Path(atlas_file).exists():
+        return gpd.GeoDataFrame(columns=ATLAS_COLUMNS, geometry=gpd.GeoSeries([], crs='EPSG:4326'))
+    filters = []
+    if burst_ids is not None:
+        filters.append(('burst_id', 'in', list(burst_ids)))
+    if baselines is not None:
+        filters.append(('baseline', 'in', [int(baseline) for baseline in baselines]))
+    return gpd.read_parquet(atlas_file, filters=filters if len(filters) > 0 else None)
+
+def _write_atlas(new, atlas_file):
+    """
+    Adds or replaces coherence estimates in the coherence atlas, sorted by burst so bursts can be read by row group.
+
+    Args:
+        new: Geodataframe with the new coherence estimates.
+        atlas_file: Path to the GeoParquet file with the coherence atlas.
+    """
+    atlas_file = Path(atlas_file)
+    atlas = load_atlas(atlas_file=atlas_file)
+    atlas = pd.concat([atlas, new], ignore_index=True) if len(atlas) > 0 else new
+    atlas = atlas.drop_duplicates(subset=['burst_id', 'baseline', 'ref_date'], keep='last')
+    atlas = atlas.sort_values(['burst_id', 'baseline', 'ref_date']).reset_index(drop=True)
+    atlas_file.parent.mkdir(parents=True, exist_ok=True)
+    temp = atlas_file.with_name(f'.{atlas_file.name}.{os.getpid()}')
+    atlas.to_parquet(temp, row_group_size=10000)
+    os.replace(temp, atlas_file)
+
+def fill_atlas(burst_ids, atlas_file = ATLAS_FILE, search = asf.search, pair_class = asf.Pair, start = '2019-12-01', end = '2021-02-01', baselines = BASELINES, max_workers = 8):
+    """
+    Estimates the coherence of the pairs of several bursts that are not in the coherence atlas yet and adds them.
+
+    The atlas is keyed by full burst id, temporal baseline and reference date (with its day of year and month),
+    so each pair is only estimated once. A local stand-in (e.g. simulation.Fixtures) can be used as search and
+    pair_class to fill it offline.
+
+    Args:
+        burst_ids: List of full burst ids.
+        atlas_file: Path to the GeoParquet file with the coherence atlas.
+        search: Search function with the same interface as asf_search.search.
+        pair_class: Class with the same interface as asf_search.Pair.
+        start: Start date of the search.
+        end: End date of the search.
+        baselines: Temporal baselines in days of the pairs.
+        max_workers: Maximum number of concurrent searches and coherence estimates.
+
+    Returns:
+        added: Number of pairs added to the atlas.
+    """
+    atlas = load_atlas(burst_ids, baselines, atlas_file)
+    done = set(zip(atlas['burst_id'], atlas['baseline'], atlas['ref_date']))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        candidates = []
+        for bid, prods in zip(burst_ids, executor.map(lambda bid: search_burst(bid, search, start, end), burst_ids)):
+            for ref, sec, baseline in get_pair_candidates(prods, baselines):
+                if (bid, baseline, ref.properties['startTime'][0:10]) not in done:
+                    candidates.append((bid, ref, sec, baseline))
+        estimates = list(executor.map(lambda candidate: estimate_pair_coherence(candidate[1], candidate[2], pair_class), candidates))
+    if len(candidates) == 0:
+        return 0
+
+    ref_dates = pd.to_datetime([ref.properties['startTime'][0:10] for _, ref, _, _ in candidates])
+    new = gpd.GeoDataFrame(
+        {
+        'burst_id': [bid for bid, _, _, _ in candidates],
+        'baseline': [baseline for _, _, _, baseline in candidates],
+        'ref_date': ref_dates.strftime('%Y-%m-%d'),
+        'sec_date': [sec.properties['startTime'][0:10] for _, _, sec, _ in candidates],
+        'doy': ref_dates.dayofyear,
+        'month': ref_dates.month,
+        'coherence': estimates,
+        },
+        geometry=[_get_footprint(ref) for _, ref, _, _ in candidates],
+        crs='EPSG:4326',
+    )
+    _write_atlas(new, atlas_file)
+    return len(new)
+
+def aggregate_atlas(atlas, period = 'month'):
+    """
+    Aggregates the coherence estimates of the atlas with the median per burst, baseline and period of the year.
+
+    Args:
+        atlas: Geodataframe with the coherence estimates (see load_atlas).
+        period: 'month' or 'doy' (day of year).
+
+    Returns:
+        profiles: Dataframe with the columns 'burst_id', 'baseline', the period, 'coherence' (median) and 'count'.
+    """
+    return (atlas.groupby(['burst_id', 'baseline', period])['coherence']
+            .agg(coherence='median', count='count').reset_index())
+
+def get_coherence_profiles(burst_ids, baselines = None, period = 'month', atlas_file = ATLAS_FILE):
+    """
+    Reads the seasonal coherence profiles of several bursts (e.g. the bursts of an area of interest
+    from aoi.get_burst_ids) from the coherence atlas.
+
+    Args:
+        burst_ids: List of full burst ids.
+        baselines: List of temporal baselines in days. If None all the baselines are read.
+        period: 'month' or 'doy' (day of year).
+        atlas_file: Path to the GeoParquet file with the coherence atlas.
+
+    Returns:
+        profiles: Dataframe with the columns 'burst_id', 'baseline', the period, 'coherence' (median) and 'count'.
+    """
+    return aggregate_atlas(load_atlas(burst_ids, baselines, atlas_file), period)
@@ -1,26 +1,48 @@
 import asf_search as asf
-import geopandas as gpd
-import glob
-import opensarlab_lib as osl
+import hashlib
+import json
+import numpy as np
 import os
 import random
+import re
 import shapely.wkt
-import subprocess
+import shutil
+import threading
+import time
+import warnings
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from datetime import datetime
+from hyp3_sdk import Batch
+from hyp3_sdk.exceptions import HyP3Error, ServerError, ServiceUnavailableError
 from osgeo import gdal, ogr
 from pathlib import Path
 from shapely.geometry import Polygon
-from rasterio.warp import transform_bounds
+from rasterio.warp import calculate_default_transform, transform_bounds
 from tqdm.auto import tqdm
+from volcsarvatory import coherence as coh
 from volcsarvatory import util
+from volcsarvatory.cache import CACHE_DIR, load_json_cache, remove_json_cache, update_json_cache
+from volcsarvatory.retry import call_with_retries
 
-def get_coherence(multiburst_dict, num = 1):
+def get_coherence(multiburst_dict, num = 1, search = asf.search, pair_class = asf.Pair, start = '2019-12-01', end = '2021-02-01', baselines = (6, 12, 18, 24, 36, 48), max_workers = 8, atlas_file = None):
     """
     Estimates the mean coherence for random burst(s) pairs in a multiburst set.
     
+    The pairs are selected from the matrix of days between the acquisition dates of each burst, and the
+    searches and coherence estimates run concurrently. With a coherence atlas, the estimates are read
+    from the atlas and only the pairs missing are estimated and added to it.
+    
     Args:
         multiburst_dict: Dictionary where the keys are the burst ids and the elements the swaths.
         num: Number of burst(s) to estimate the mean coherence.
+        search: Search function with the same interface as asf_search.search.
+        pair_class: Class with the same interface as asf_search.Pair.
+        start: Start date of the search.
+        end: End date of the search.
+        baselines: Temporal baselines in days of the pairs.
+        max_workers: Maximum number of concurrent searches and coherence estimates.
+        atlas_file: Path to the GeoParquet file with the coherence atlas. If None the atlas is not used.
     
     Returns:
         coherence: Dictionary where the keys are the number of days between the pairs and the
@@ -34,21 +56,27 @@ def get_coherence(multiburst_dict, num = 1):
 
     bids = random.sample(burst_ids,num)
 
-    for bid in bids:
-        prods = asf.search(fullBurstID = bid, start = '2019-12-01', end = '2021-02-01', polarization = asf.POLARIZATION.VV)[::-1]
-        for i, ref in enumerate(prods[0:-1]):
-            for sec in prods[i+1::]:
-                pair = asf.Pair(ref, sec)
-                if pair.temporal_baseline.days in [6,12,18,24,36,48]:
-                    ref_date = ref.properties["stopTime"].split('T')[0]
-                    sec_date = sec.properties["stopTime"].split('T')[0]
-                    if pair.temporal_baseline.days not in coherence.keys():
-                        coherence[pair.temporal_baseline.days] = dict()
-                    else:
-                        if ref_date in coherence[pair.temporal_baseline.days].keys():
-                            coherence[pair.temporal_baseline.days][ref_date] += pair.estimate_s1_mean_coherence()/num
-                        else:
-                            coherence[pair.temporal_baseline.days][ref_date] = pair.estimate_s1_mean_coherence()/num
+    if atlas_file is not None:
+        coh.fill_atlas(bids, atlas_file, search, pair_class, start, end, baselines, max_workers)
+        atlas = coh.load_atlas(bids, baselines, atlas_file)
+        atlas = atlas[(atlas['ref_date'] >= str(start)[0:10]) & (atlas['sec_date'] <= str(end)[0:10])]
+        for baseline, ref_date, estimate in zip(atlas['baseline'], atlas['ref_date'], atlas['coherence']):
+            if baseline not in coherence.keys():
+                coherence[baseline] = dict()
+            coherence[baseline][ref_date] = coherence[baseline].get(ref_date, 0) + estimate/num
+        return coherence
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        candidates = []
+        for prods in executor.map(lambda bid: coh.search_burst(bid, search, start, end), bids):
+            candidates += coh.get_pair_candidates(prods, baselines)
+        estimates = executor.map(lambda pair: coh.estimate_pair_coherence(pair[0], pair[1], pair_class), candidates)
+
+        for (ref, sec, baseline), estimate in zip(candidates, estimates):
+            ref_date = ref.properties["stopTime"].split('T')[0]
+            if baseline not in coherence.keys():
+                coherence[baseline] = dict()
+            coherence[baseline][ref_date] = coherence[baseline].get(ref_date, 0) + estimate/num
     return coherence
 
 def prepare_multiburst_jobs(refs, secs, project_name, hyp3, looks = '20x4', apply_water_mask = True):
@@ -77,87 +105,612 @@ def prepare_multiburst_jobs(refs, secs, project_name, hyp3, looks = '20x4', appl
         insar_jobs.append(hyp3.prepare_insar_isce_multi_burst_job(ref, sec, name=project_name, apply_water_mask=True))
     return insar_jobs
 
-def submit_jobs(insar_jobs, hyp3):
+def _get_job_key(job_type, name, job_parameters):
+    """
+    Gets a key that identifies a job by its type, name and pair of scenes.
+    
+    Args:
+        job_type: Type of the HyP3 job.
+        name: Name of the job.
+        job_parameters: Dictionary with the parameters of the job.
+    
+    Returns:
+        key: SHA1 hex digest of the job.
+    """
+    job = {'job_type': job_type, 'name': name,
+           'reference': job_parameters.get('reference'), 'secondary': job_parameters.get('secondary')}
+    return hashlib.sha1(json.dumps(job, sort_keys=True).encode('utf-8')).hexdigest()
+
+def _get_status_code(e):
+    """
+    Gets the HTTP status code of a HyP3 error.
+    
+    hyp3_sdk does not keep the response in its exceptions, but their message starts with the response
+    (e.g. '<Response [429]> Rate limit exceeded'), so the code is read from it.
+    
+    Args:
+        e: Exception raised by hyp3_sdk.
+    
+    Returns:
+        status_code: HTTP status code, or None if the message has none.
+    """
+    match = re.match(r'<Response \[(\d{3})\]>', str(e))
+    return None if match is None else int(match.group(1))
+
+def _is_transient(e):
+    """
+    Checks if a HyP3 submission error is worth retrying: server and connection errors and rate limits (HTTP 429).
+    
+    Args:
+        e: Exception raised by the submission.
+    
+    Returns:
+        transient: True if the submission should be retried.
+    """
+    if isinstance(e, HyP3Error):
+        return _get_status_code(e) == 429
+    return True
+
+def _is_rejected(e):
+    """
+    Checks if a HyP3 submission error means that the batch was rejected without creating any job:
+    rate limits (HTTP 429) and an unavailable API (HTTP 503).
+    
+    Args:
+        e: Exception raised by the submission.
+    
+    Returns:
+        rejected: True if none of the jobs of the batch were created.
+    """
+    return isinstance(e, ServiceUnavailableError) or (isinstance(e, HyP3Error) and _get_status_code(e) == 429)
+
+def _find_accepted_jobs(keys, hyp3):
+    """
+    Looks up in HyP3 the jobs that were accepted among jobs that may have been submitted.
+    
+    Failed jobs are ignored, so a pair submitted again under the same name after its job failed is not
+    taken as accepted.
+    
+    Args:
+        keys: Dictionary where the keys are the job keys and the elements the job names.
+        hyp3: Instance of HyP3 where the user has been logged in.
+    
+    Returns:
+        accepted: Dictionary where the keys are the job keys and the elements the accepted jobs.
+    """
+    accepted = dict()
+    for name in set(keys.values()):
+        for job in call_with_retries(hyp3.find_jobs, name=name, exceptions=(ServerError, ServiceUnavailableError, ConnectionError, OSError)):
+            key = _get_job_key(job.job_type, job.name, job.job_parameters)
+            if key in keys.keys() and not job.failed():
+                accepted[key] = job
+    return accepted
+
+def _reconcile_journal(journal_file, keys, hyp3):
+    """
+    Looks up in HyP3 the jobs that were being submitted when a previous run stopped and records the ones accepted.
+    
+    Args:
+        journal_file: Path to the JSON journal.
+        keys: Dictionary where the keys are the job keys in the journal being submitted and the elements the job names.
+        hyp3: Instance of HyP3 where the user has been logged in.
+    """
+    accepted = _find_accepted_jobs(keys, hyp3)
+    if len(accepted) > 0:
+        update_json_cache(journal_file, {key: job.job_id for key, job in accepted.items()})
+
+def _submit_batch(batch, hyp3, retries, backoff):
+    """
+    Submits a batch of prepared jobs retrying transient errors with backoff.
+    
+    Submissions are not idempotent: a batch that failed with a server or connection error may have been
+    created before the response was lost. Before retrying it, the jobs of the batch are looked up in HyP3 and
+    only the ones not found are submitted again. Rejections (HTTP 429 and 503) are retried directly.
+    
+    Args:
+        batch: List of tuples (job key, prepared job).
+        hyp3: Instance of HyP3 where the user has been logged in.
+        retries: Number of retries after the first attempt.
+        backoff: Base waiting time in seconds between retries.
+    
+    Returns:
+        jobs: Batch with the submitted jobs.
+    """
+    accepted = []
+    maybe_sent = False
+    for attempt in range(retries + 1):
+        if maybe_sent:
+            found = _find_accepted_jobs({key: job.get('name') for key, job in batch}, hyp3)
+            accepted += list(found.values())
+            batch = [(key, job) for key, job in batch if key not in found.keys()]
+            if len(batch) == 0:
+                return Batch(accepted)
+        try:
+            return Batch(accepted + list(hyp3.submit_prepared_jobs([job for _, job in batch])))
+        except (ServerError, ServiceUnavailableError, HyP3Error, ConnectionError, OSError) as e:
+            if attempt == retries or not _is_transient(e):
+                raise
+            maybe_sent = not _is_rejected(e)
+            time.sleep(random.uniform(0, backoff * 2**attempt))
+
+def submit_jobs(insar_jobs, hyp3, batch_size = 100, max_workers = 2, journal_file = None, retries = 5, backoff = 10):
     """
     Submits prepared multiburst jobs.
     
+    Batches are submitted concurrently and retried with exponential backoff on server errors and rate limits.
+    Jobs of a failed batch that HyP3 created anyway are looked up before retrying it, so they are not duplicated.
+    With a journal, the accepted jobs are recorded as each batch is accepted and jobs already in the journal
+    are skipped, so a submission that stopped midway can be run again without duplicating jobs. Jobs that
+    were in flight when it stopped are looked up in HyP3 before submitting them again.
+    
     Args:
         insar_jobs: Prepared multiburst jobs.
-        hyp3: Instance of HyP3 where the user has been logged in.
+        hyp3: Instance of HyP3 where the user has been logged in (or a stand-in with the same interface).
+        batch_size: Maximum number of jobs per batch.
+        max_workers: Maximum number of batches submitted at the same time.
+        journal_file: Path to the JSON journal of submitted jobs. If None no journal is kept.
+        retries: Number of retries of each batch.
+        backoff: Base waiting time in seconds between retries.
     
     Returns:
         jobs: List of submitted batches.
     """
-    batches = int(len(insar_jobs)/100)+1
+    keys = [_get_job_key(job['job_type'], job.get('name'), job['job_parameters']) for job in insar_jobs]
+    journal = dict()
+    if journal_file is not None:
+        journal = load_json_cache(journal_file)
+        in_flight = {key: job.get('name') for key, job in zip(keys, insar_jobs) if key in journal.keys() and journal[key] is None}
+        if len(in_flight) > 0:
+            _reconcile_journal(journal_file, in_flight, hyp3)
+            journal = load_json_cache(journal_file)
+    pending = [(key, job) for key, job in zip(keys, insar_jobs) if journal.get(key) is None]
+    if len(pending) < len(insar_jobs):
+        print(f'{len(insar_jobs) - len(pending)} jobs already submitted')
+    batches = [pending[i:i+batch_size] for i in range(0, len(pending), batch_size)]
+
+    lock = threading.Lock()
+    def submit(batch):
+        if journal_file is not None:
+            with lock:
+                update_json_cache(journal_file, {key: None for key, _ in batch})
+        submitted = _submit_batch(batch, hyp3, retries, backoff)
+        if journal_file is not None:
+            with lock:
+                update_json_cache(journal_file, {_get_job_key(job.job_type, job.name, job.job_parameters): job.job_id for job in submitted})
+        return submitted
+
+    start = time.perf_counter()
     jobs = []
-    for batch in range(batches):
-        ini=batch*100
-        if batch==batches-1:
-            fin=batch*100+len(insar_jobs)%100
-        else:
-            fin=(batch+1)*100
-        jobs.append(hyp3.submit_prepared_jobs(insar_jobs[ini:fin]))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for submitted in tqdm(executor.map(submit, batches), total=len(batches), desc='Submitting'):
+            jobs.append(submitted)
+    elapsed = time.perf_counter() - start
+    if len(pending) > 0:
+        print(f'Submitted {len(pending)} jobs in {len(batches)} batches in {elapsed:.1f} s ({len(pending)/elapsed:.1f} jobs/s)')
+    return jobs
+    
+def _get_pair_key(reference, secondary):
+    """
+    Gets a key that identifies a multiburst pair by its reference and secondary granule ids.
+    
+    Args:
+        reference: List of reference granule ids.
+        secondary: List of secondary granule ids.
+    
+    Returns:
+        key: Key of the pair.
+    """
+    return '+'.join(sorted(reference)) + '/' + '+'.join(sorted(secondary))
+
+def record_processed_pairs(jobs, record_file):
+    """
+    Adds the pairs of HyP3 jobs to the record of processed pairs of a network.
+    
+    It can be used to start the record of a network processed before, e.g. with hyp3.find_jobs(name=project_name).
+    
+    Args:
+        jobs: HyP3 jobs (or batches of jobs).
+        record_file: Path to the JSON file with the record of processed pairs.
+    
+    Returns:
+        recorded: Number of pairs in the jobs.
+    """
+    entries = dict()
+    for job in jobs:
+        for j in (job if isinstance(job, (list, tuple)) or hasattr(job, 'jobs') else [job]):
+            entries[_get_pair_key(j.job_parameters['reference'], j.job_parameters['secondary'])] = j.job_id
+    update_json_cache(record_file, entries)
+    return len(entries)
+
+def update_network(refs, secs, project_name, hyp3, record_file = None, looks = '20x4', apply_water_mask = True, **kwargs):
+    """
+    Prepares and submits only the pairs of a network that have not been processed yet.
+    
+    The pairs are compared by their reference and secondary granule ids with a record of the processed pairs
+    of the network, which is updated with the jobs accepted. Before comparing them, the jobs of the project are
+    looked up in HyP3 and the pairs whose jobs failed are removed from the record and the journal, so they are
+    submitted again. download_pairs only downloads the products that are not in the folder yet, so running both
+    after a new acquisition processes and downloads the new pairs only.
+    
+    Args:
+        refs: Reference scene ids of the whole network.
+        secs: Secondary scene ids of the whole network.
+        project_name: Name of the project in HyP3.
+        hyp3: Instance of HyP3 where the user has been logged in.
+        record_file: Path to the JSON file with the record of processed pairs. If None it uses the file of the project in cache.
+        looks: Multilooking in the final products.
+        apply_water_mask: If true it applies a water mask in the HyP3 processing.
+        kwargs: Keyword arguments for submit_jobs.
+    
+    Returns:
+        jobs: List of submitted batches.
+    """
+    if record_file is None:
+        record_file = CACHE_DIR / 'networks' / f'{project_name}.json'
+    record_file = Path(record_file)
+    kwargs.setdefault('journal_file', record_file.with_name(f'{record_file.stem}_journal.json'))
+    record = load_json_cache(record_file)
+    journal = load_json_cache(kwargs['journal_file']) if kwargs['journal_file'] is not None else dict()
+    if len(record) > 0 or len(journal) > 0:
+        failed = {job.job_id for job in call_with_retries(hyp3.find_jobs, name=project_name,
+                                                          exceptions=(ServerError, ServiceUnavailableError, ConnectionError, OSError))
+                  if job.failed()}
+        failed_pairs = [key for key, job_id in record.items() if job_id in failed]
+        if len(failed_pairs) > 0:
+            print(f'{len(failed_pairs)} failed pairs will be submitted again')
+            remove_json_cache(record_file, failed_pairs)
+            record = load_json_cache(record_file)
+        failed_jobs = [key for key, job_id in journal.items() if job_id in failed]
+        if len(failed_jobs) > 0:
+            remove_json_cache(kwargs['journal_file'], failed_jobs)
+
+    insar_jobs = prepare_multiburst_jobs(refs, secs, project_name, hyp3, looks=looks, apply_water_mask=apply_water_mask)
+    new_jobs = [job for job in insar_jobs
+                if _get_pair_key(job['job_parameters']['reference'], job['job_parameters']['secondary']) not in record.keys()]
+    print(f'{len(new_jobs)} new pairs out of {len(insar_jobs)} in the network')
+    if len(new_jobs) == 0:
+        return []
+
+    jobs = submit_jobs(new_jobs, hyp3, **kwargs)
+    record_processed_pairs(jobs, record_file)
     return jobs
+
+MINTPY_LAYERS = ('unw_phase', 'corr', 'conncomp', 'dem', 'lv_theta', 'lv_phi', 'water_mask')
+
+def _get_mintpy_name(name, burst, new):
+    """
+    Gets the MintPy standard name of a file in a HyP3 product.
+    
+    Args:
+        name: Name of the file.
+        burst: Burst of the reference granule ('burst number_swath').
+        new: True for the multiburst product names.
+    
+    Returns:
+        newname: Name of the file for MintPy.
+    """
+    if new:
+        return 'S1_' + burst + '_' + '_'.join([n for n in name.split('_')[3:]])
+    return 'S1_' + burst + '_' + '_'.join([n for n in name.split('_')[10:]])
+
+def _is_layer(name, layers):
+    """
+    Checks if a file of a HyP3 product is one of the layers. The product metadata is always included.
+    
+    Args:
+        name: Name of the file.
+        layers: List of layer names (e.g. 'unw_phase'). If None all the files are included.
+    
+    Returns:
+        included: True if the file is included.
+    """
+    if layers is None or ('.txt' in name and 'README' not in name):
+        return True
+    return any(name.endswith(f'_{layer}.tif') for layer in layers)
+
+def _unpack_product(zip_file, folder, layers = None):
+    """
+    Extracts a HyP3 product zip into the folder renaming the product and its files to MintPy standards.
+    
+    The files are written to their final names straight from the zip (whose CRCs are checked while reading)
+    into a temporary folder that is renamed when complete, so an interrupted unpack leaves no partial product.
+    
+    Args:
+        zip_file: Path to the zip file.
+        folder: Folder where the product is extracted.
+        layers: List of layer names to extract (e.g. 'unw_phase'). If None all the files are extracted.
+    
+    Returns:
+        product: Path to the product folder.
+        files: List with the names of the extracted files.
+    """
+    with zipfile.ZipFile(zip_file) as zf:
+        members = [member for member in zf.infolist() if not member.is_dir()]
+        product_name = Path(members[0].filename).parts[0]
+        new = product_name.count('_') <= 7
+        txt = next(member for member in members if '.txt' in member.filename and 'README' not in member.filename)
+        line = zf.read(txt).decode('utf-8').splitlines()[0]
+        burst = line.split('_')[1]+'_'+line.split('_')[2]
+        foldername = _get_mintpy_name(Path(txt.filename).name, burst, new).split('.')[0]
+
+        product = folder / foldername
+        temp = folder / f'.{foldername}.partial'
+        if temp.exists():
+            shutil.rmtree(temp)
+        temp.mkdir()
+        files = []
+        for member in members:
+            if not _is_layer(Path(member.filename).name, layers):
+                continue
+            newname = _get_mintpy_name(Path(member.filename).name, burst, new)
+            with zf.open(member) as src, open(temp / newname, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024*1024)
+            files.append(newname)
+    if product.exists():
+        shutil.rmtree(product)
+    os.replace(temp, product)
+    return product, files
+
+def _download_product(job, folder, layers = None):
+    """
+    Downloads a HyP3 product, unpacks it to MintPy standards and removes the zip.
     
-def download_pairs(project_name, hyp3, folder = None):
+    Args:
+        job: HyP3 job that has succeeded.
+        folder: Folder where the product is extracted.
+        layers: List of layer names to extract (e.g. 'unw_phase'). If None all the files are extracted.
+    
+    Returns:
+        product: Path to the product folder.
+        files: List with the names of the extracted files.
+    """
+    zip_file = call_with_retries(job.download_files, folder)[0]
+    try:
+        return _unpack_product(zip_file, folder, layers)
+    finally:
+        zip_file.unlink(missing_ok=True)
+
+def _is_downloaded(entry, folder, layers = None):
+    """
+    Checks if a product recorded in the download manifest is still present with the layers requested.
+    
+    Args:
+        entry: Manifest entry with the product folder, the files and the layers extracted.
+        folder: Folder with the products.
+        layers: List of layer names requested. If None all the files are requested.
+    
+    Returns:
+        downloaded: True if the product folder has all the files and they include the layers requested.
+    """
+    if entry is None:
+        return False
+    if entry.get('layers') is not None and (layers is None or not set(layers) <= set(entry['layers'])):
+        return False
+    product = folder / entry['product']
+    return all((product / name).exists() for name in entry['files'])
+
+def download_pairs(project_name, hyp3, folder = None, max_workers = 4, layers = None):
     """
     Downloads HyP3 products and renames files to meet MintPy standards
     
+    Each product is unpacked and renamed as soon as it is downloaded, with at most max_workers products in
+    flight. Products are recorded in a manifest ('.downloads.json' in the folder) when they are complete, so
+    running it again only downloads the products that are missing. The working directory is not changed.
+    With layers, only those layers and the product metadata are extracted from the zips (MINTPY_LAYERS has
+    the layers used by set_same_frame and MintPy).
+    
     Args:
         project_name: Name of the HyP3 project.
         hyp3: Instance of HyP3 where the user has been logged in.
         folder: Folder name that will contain the downloaded products. If None it will create a folder with the project name.
+        max_workers: Maximum number of products downloaded and unpacked at the same time.
+        layers: List of layer names to extract (e.g. MINTPY_LAYERS). If None all the files are extracted.
+    
+    Returns:
+        products: List with the paths to the product folders.
     """
     jobs = hyp3.find_jobs(name=project_name)
 
-    cwd = os.getcwd()
     if folder is None:
         folder = project_name
-    if not os.path.isdir(folder):
-        os.mkdir(folder)
     folder = Path(folder)
-    file_list = jobs.download_files(folder)
-    for z in file_list:
-        osl.asf_unzip(str(folder), str(z))
-        z.unlink()
-
-    os.chdir(str(folder))
-    folders=glob.glob('./*')
-    folders=[fol for fol in folders if os.path.isdir(fol)]
-
-    for fol in folders:
-        new = True
-        if str(fol).count('_') > 7:
-            new = False
-        os.chdir(fol)
-        fs=glob.glob('./*')
-        txts=[t for t in fs if '.txt' in t and 'README' not in t]
-        ar=open(txts[0])
-        lines=ar.readlines()
-        ar.close()
-        burst=lines[0].split('_')[1]+'_'+lines[0].split('_')[2]
-        for f in fs:
-            name=os.path.basename(f)
-            if new:
-                newname = 'S1_' + burst + '_' + '_'.join([n for n in name.split('_')[3:]])
-            else:
-                newname = 'S1_' + burst + '_' + '_'.join([n for n in name.split('_')[10:]])
-            if '.txt' in newname and 'README' not in newname:
-                foldername=newname.split('.')[0]
-            subprocess.call('mv '+name+' '+newname,shell=True)
-        os.chdir(cwd)
-        os.chdir(str(folder))
-        subprocess.call('mv '+os.path.basename(fol)+' '+foldername,shell=True)
-    os.chdir(cwd)
-    
-def set_same_frame(folder, wgs84 = False):
+    folder.mkdir(parents=True, exist_ok=True)
+    manifest_file = folder / '.downloads.json'
+    manifest = load_json_cache(manifest_file)
+
+    succeeded = [job for job in jobs if job.succeeded()]
+    if len(succeeded) < len(jobs):
+        warnings.warn(f'{len(jobs) - len(succeeded)} jobs have not succeeded and will not be downloaded', UserWarning)
+    products = [folder / manifest[job.job_id]['product'] for job in succeeded if _is_downloaded(manifest.get(job.job_id), folder, layers)]
+    pending = [job for job in succeeded if not _is_downloaded(manifest.get(job.job_id), folder, layers)]
+    if len(products) > 0:
+        print(f'{len(products)} products already downloaded')
+
+    lock = threading.Lock()
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_download_product, job, folder, layers): job for job in pending}
+        for future in tqdm(as_completed(futures), total=len(futures), desc='Downloading'):
+            job = futures[future]
+            try:
+                product, files = future.result()
+            except Exception as e:
+                failed.append(job.job_id)
+                warnings.warn(f'Download of job {job.job_id} failed: {e}', UserWarning)
+                continue
+            with lock:
+                update_json_cache(manifest_file, {job.job_id: {'product': product.name, 'files': files, 'layers': None if layers is None else list(layers)}})
+            products.append(product)
+    if len(failed) > 0:
+        warnings.warn(f'{len(failed)} products failed to download. Run it again to retry them.', UserWarning)
+    return products
+    
+def _init_gdal(gdal_cache_mb):
+    """
+    Sets the GDAL block cache of a worker process.
+    
+    Args:
+        gdal_cache_mb: Maximum size in MB of the GDAL block cache.
+    """
+    gdal.UseExceptions()
+    gdal.SetCacheMax(int(gdal_cache_mb) * 1024 * 1024)
+
+def _reproject_tiff(pth, src_epsg, dst_epsg, res, no_data_val):
+    """
+    Reprojects a tiff in place to another EPSG keeping its resolution and no data value.
+    
+    Args:
+        pth: Path to the tiff.
+        src_epsg: EPSG of the tiff.
+        dst_epsg: EPSG to reproject to.
+        res: Pixel size of the tiff.
+        no_data_val: No data value of the tiff.
+    """
+    temp = pth.parent/f"temp_{pth.stem}.tif"
+    pth.rename(temp)
+    warp_options = {
+        "dstSRS":f"EPSG:{dst_epsg}", "srcSRS":f"EPSG:{src_epsg}",
+        "targetAlignedPixels":True,
+        "xRes":res, "yRes":res,
+        "dstNodata": no_data_val
+    }
+    gdal.Warp(str(pth), str(temp), **warp_options)
+    temp.unlink()
+
+def _subset_tiff(pth, proj_win):
+    """
+    Subsets a tiff in place to a window.
+    
+    Args:
+        pth: Path to the tiff.
+        proj_win: Window [xmin, ymax, xmax, ymin] in the coordinates of the tiff.
+    """
+    temp_pth = pth.parent/f'subset_{pth.name}'
+    gdal.Translate(destName=str(temp_pth), srcDS=str(pth), projWin=proj_win)
+    pth.unlink()
+    temp_pth.rename(pth)
+
+def _to_wgs84(pth):
+    """
+    Reprojects a tiff in place to WGS84.
+    
+    Args:
+        pth: Path to the tiff.
+    """
+    temp = pth.parent/f"temp_{pth.name}"
+    gdal.Warp(str(temp), str(pth), dstSRS='EPSG:4326')
+    os.replace(temp, pth)
+
+def _warp_to_grid(pth, dst_epsg, bounds, res, no_data_val, vrt = False):
+    """
+    Warps and crops a tiff to a grid with a single GDAL operation.
+    
+    Args:
+        pth: Path to the tiff.
+        dst_epsg: EPSG of the grid.
+        bounds: Bounds (xmin, ymin, xmax, ymax) of the grid.
+        res: Pixel size of the grid.
+        no_data_val: No data value of the tiff.
+        vrt: If True it writes a VRT next to the tiff instead of replacing the tiff.
+    """
+    warp_options = {
+        "dstSRS":f"EPSG:{dst_epsg}",
+        "outputBounds":bounds,
+        "xRes":res, "yRes":res,
+        "dstNodata": no_data_val
+    }
+    if vrt:
+        gdal.Warp(str(pth.with_suffix('.vrt')), str(pth), format='VRT', **warp_options)
+        return
+    temp = pth.parent/f"temp_{pth.name}"
+    gdal.Warp(str(temp), str(pth), **warp_options)
+    os.replace(temp, pth)
+
+def get_common_grid(gdf, wgs84 = False):
+    """
+    Computes the grid covered by all the tiffs, aligned to the pixel size.
+    
+    The grid is in the predominant EPSG of the tiffs (or WGS84) with the pixel size of the tiffs in that EPSG.
+    In the predominant EPSG it is aligned to the pixels of the first tiff in that EPSG, so tiffs on the same
+    pixel grid are cropped without shifting them.
+    
+    Args:
+        gdf: Geodataframe with the metadata of the tiffs (see util.scan_tiffs).
+        wgs84: If True the grid is in WGS84.
+    
+    Returns:
+        epsg: EPSG of the grid.
+        bounds: Bounds (xmin, ymin, xmax, ymax) of the grid.
+        res: Pixel size of the grid.
+    """
+    epsg = gdf['EPSG'].value_counts().idxmax()
+    predominant = gdf.loc[gdf['EPSG'] == epsg]
+    res = float(predominant['res'].iloc[0])
+    x_origin, _, _, y_origin = predominant['geometry'].iloc[0].bounds
+
+    bounds = np.array([transform_bounds(f'EPSG:{src_epsg}', f'EPSG:{epsg}', *geometry.bounds, densify_pts=21)
+                       for src_epsg, geometry in zip(gdf['EPSG'], gdf['geometry'])])
+    origin = np.array([x_origin, y_origin])
+    xmin, ymin = origin + np.ceil((bounds[:, :2].max(axis=0) - origin) / res) * res
+    xmax, ymax = origin + np.floor((bounds[:, 2:].min(axis=0) - origin) / res) * res
+    if xmin >= xmax or ymin >= ymax:
+        raise Exception('Error determining area of common coverage')
+
+    if wgs84:
+        transform, _, _ = calculate_default_transform(f'EPSG:{epsg}', 'EPSG:4326', int(round((xmax - xmin) / res)),
+                                                      int(round((ymax - ymin) / res)), xmin, ymin, xmax, ymax)
+        res = transform.a
+        xmin, ymin, xmax, ymax = transform_bounds(f'EPSG:{epsg}', 'EPSG:4326', xmin, ymin, xmax, ymax, densify_pts=21)
+        xmin, ymin = np.ceil(np.array([xmin, ymin]) / res) * res
+        xmax, ymax = np.floor(np.array([xmax, ymax]) / res) * res
+        epsg = 4326
+    return epsg, (float(xmin), float(ymin), float(xmax), float(ymax)), res
+
+def _run_parallel(func, args, num_workers = None, gdal_cache_mb = 256, desc = None):
+    """
+    Runs a function for each set of arguments in a process pool, reporting the progress as the tasks finish.
+    
+    Args:
+        func: Function to run.
+        args: List of tuples with the arguments of each task.
+        num_workers: Number of processes. If None it uses the number of CPUs.
+        gdal_cache_mb: Maximum size in MB of the GDAL block cache of each process.
+        desc: Description shown in the progress bar.
+    """
+    if len(args) == 0:
+        return
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_gdal, initargs=(gdal_cache_mb,)) as executor:
+        futures = {executor.submit(func, *arg): arg for arg in args}
+        with tqdm(total=len(futures), desc=desc) as progress:
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    for f in futures:
+                        f.cancel()
+                    raise RuntimeError(f'{desc} failed for {futures[future][0]}') from e
+                progress.update(1)
+
+def set_same_frame(folder, wgs84 = False, num_workers = None, gdal_cache_mb = 256, mode = 'steps'):
     """
     Checks the coordinate system for all the files in the folder and reprojects them if necessary
     
+    The work on each file runs in a process pool. With mode 'steps' the files are reprojected, subset to the
+    common coverage of the unwrapped phases and converted to WGS84 one step at a time. With mode 'single' the
+    common grid of all the tiffs is computed first (see get_common_grid) and each file is warped and cropped
+    to it with one GDAL operation, resampling with nearest neighbour. With mode 'vrt' the tiffs are left
+    untouched and a VRT on the common grid is written next to each of them, so no pixels are copied until
+    they are read.
+    
     Args:
         folder: Path to the folder that has the HyP3 products.
         wgs84: If True reprojects all the files to WGS84 system.
+        num_workers: Number of processes. If None it uses the number of CPUs.
+        gdal_cache_mb: Maximum size in MB of the GDAL block cache of each process.
+        mode: 'single', 'vrt' or 'steps'.
     """
+    if mode not in ('single', 'vrt', 'steps'):
+        raise ValueError(f"mode must be 'single', 'vrt' or 'steps', not {mode}")
     data_path = Path(folder)
     dem = sorted(list(data_path.glob('*/*dem*.tif')))
     lv_phi = sorted(list(data_path.glob('*/*lv_phi*.tif')))
@@ -167,47 +720,32 @@ def set_same_frame(folder, wgs84 = False):
     corr = sorted(list(data_path.glob('*/*_corr*.tif')))
     conn_comp = sorted(list(data_path.glob('*/*_conncomp*.tif')))
     tiff_path = dem + lv_phi + lv_theta + water_mask + unw + corr + conn_comp
-    
-    gdf = gpd.GeoDataFrame(
-        {
-        'tiff_path': tiff_path,
-        'EPSG': [util.get_epsg(p) for p in tiff_path],
-        'geometry': [util.get_geotiff_bbox(p) for p in tiff_path],
-        }
-    )
+
+    index_file = data_path / '.tiff_metadata.json'
+    gdf = util.scan_tiffs(tiff_path, index_file=index_file)
+
+    if mode != 'steps':
+        epsg, bounds, res = get_common_grid(gdf, wgs84=wgs84)
+        print(f'common grid: EPSG {epsg}, bounds {bounds}, resolution {res}')
+        _run_parallel(_warp_to_grid, [(pth, epsg, bounds, res, no_data_val, mode == 'vrt') for pth, no_data_val in zip(tiff_path, gdf['nodata'])],
+                      num_workers=num_workers, gdal_cache_mb=gdal_cache_mb, desc='Warping')
+        return
 
     # check for multiple projections and project to the predominant EPSG 
     if gdf['EPSG'].nunique() > 1:
         proj_count = gdf['EPSG'].value_counts()
         predominant_epsg = proj_count.idxmax()
         print(f'reprojecting to predominant EPSG: {predominant_epsg}')
-        for _, row in gdf.loc[gdf['EPSG'] != predominant_epsg].iterrows():
-            pth = row['tiff_path']
-            no_data_val = util.get_no_data_val(pth)
-            res = util.get_res(pth)
-        
-            temp = pth.parent/f"temp_{pth.stem}.tif"
-            pth.rename(temp)
-            src_epsg = row['EPSG']
-
-            warp_options = {
-                "dstSRS":f"EPSG:{predominant_epsg}", "srcSRS":f"EPSG:{src_epsg}",
-                "targetAlignedPixels":True,
-                "xRes":res, "yRes":res,
-                "dstNodata": no_data_val
-            }
-            gdal.Warp(str(pth), str(temp), **warp_options)
-            temp.unlink()
-
-        gdf = gpd.GeoDataFrame(
-        {
-        'tiff_path': tiff_path,
-        'EPSG': [util.get_epsg(p) for p in tiff_path],
-        'geometry': [util.get_geotiff_bbox(p) for p in tiff_path],
-        }
-        )
-    common_extents = osl.get_common_coverage_extents(unw)
-    xmin, ymin, xmax, ymax = transform_bounds(int(osl.get_projection(str(unw[0]))), 3857, *common_extents)
+        reproject = gdf.loc[gdf['EPSG'] != predominant_epsg]
+        _run_parallel(_reproject_tiff, list(zip(reproject['tiff_path'], reproject['EPSG'], [predominant_epsg]*len(reproject),
+                                                reproject['res'], reproject['nodata'])),
+                      num_workers=num_workers, gdal_cache_mb=gdal_cache_mb, desc='Reprojecting')
+
+        gdf = util.scan_tiffs(tiff_path, index_file=index_file)
+    unw_gdf = gdf.loc[gdf['tiff_path'].astype(str).isin([str(pth) for pth in unw])]
+    unw_bounds = np.array([geometry.bounds for geometry in unw_gdf['geometry']])
+    common_extents = [*unw_bounds[:, :2].max(axis=0).tolist(), *unw_bounds[:, 2:].min(axis=0).tolist()]
+    xmin, ymin, xmax, ymax = transform_bounds(int(unw_gdf.iloc[0]['EPSG']), 3857, *common_extents)
     common_extents_3857 = [xmin, ymin, xmax, ymax]
     print(common_extents)
     correct_wkt_input = False
@@ -226,14 +764,10 @@ def set_same_frame(folder, wgs84 = False):
 
     shp_path = data_path / f'shape_{datetime.strftime(datetime.now(), "%Y%m%dT%H%M%S")}.shp'
     util.save_shapefile(wkt_ogr_geom, epsg, shp_path)
-    for pth in tqdm(gdf['tiff_path']):
-        print(f'Subsetting: {pth}')
-        temp_pth = pth.parent/f'subset_{pth.name}'
-        gdal.Translate(destName=str(temp_pth), srcDS=str(pth), projWin=[common_extents[0], common_extents[3], common_extents[2], common_extents[1]])
-        pth.unlink()
-        temp_pth.rename(pth)
+    proj_win = [common_extents[0], common_extents[3], common_extents[2], common_extents[1]]
+    _run_parallel(_subset_tiff, [(pth, proj_win) for pth in gdf['tiff_path']],
+                  num_workers=num_workers, gdal_cache_mb=gdal_cache_mb, desc='Subsetting')
 
     if wgs84:
-        for pth in tqdm(gdf['tiff_path']):
-            print(f'Converting {pth} to WGS84')
-            gdal.Warp(str(pth), str(pth), dstSRS='EPSG:4326')
+        _run_parallel(_to_wgs84, [(pth,) for pth in gdf['tiff_path']],
+                      num_workers=num_workers, gdal_cache_mb=gdal_cache_mb, desc='Converting to WGS84')
@@ -1,8 +1,25 @@
 import asf_search as asf
+import hashlib
+import json
+import numpy as np
+import os
 import pandas as pd
-import time
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from asf_search.exceptions import InvalidMultiBurstCountError, InvalidMultiBurstTopologyError
+from volcsarvatory.cache import CACHE_DIR
+from volcsarvatory.retry import call_with_retries
+
+MULTIBURST_CACHE = CACHE_DIR / 'multibursts'
+SWATHS = ("IW1", "IW2", "IW3")
+SWATH_GROUPINGS = [((0, 1, 2),), ((0, 1), (2,)), ((0,), (1, 2)), ((0,), (1,), (2,))]
+SWATH_GROUPS = sorted(set(group for grouping in SWATH_GROUPINGS for group in grouping))
+SWATH_COMBINATIONS = [tuple(swath for i, swath in enumerate(SWATHS) if code & (1 << i)) for code in range(1 << len(SWATHS))]
+MAX_BURSTS = 30
+
+_multiburst_cache = dict()
 
 def get_julian_season(season) -> tuple[int,int]:
     """
@@ -24,12 +41,18 @@ def get_julian_season(season) -> tuple[int,int]:
     season_end_day = season_end_ts.timetuple().tm_yday
     return (season_start_day, season_end_day)
 
-def get_multibursts(burst_ids):
+def get_multibursts(burst_ids, max_workers = 4, set_cost = 3, multiburst_class = asf.MultiBurst, use_cache = True):
     """
     Get Multiburst objects from a list of burst ids.
     
+    The bursts of every path are partitioned first, and then all the multiburst sets are validated in one pool.
+    
     Args:
         burst_ids: List with the burst IDs.
+        max_workers: Maximum number of multiburst sets validated concurrently.
+        set_cost: Cost of a multiburst set measured in bursts, used to choose how to split the bursts.
+        multiburst_class: Class used to create and validate the multiburst sets.
+        use_cache: If True it reads and writes the cache of validated multiburst sets.
     
     Returns:
         multibursts: List of Multiburst objects associated with the burst IDs.
@@ -43,317 +66,493 @@ def get_multibursts(burst_ids):
         else:
             path_dict[path].append(bid)
 
-    multibursts = []
+    multiburst_dicts = []
     for path in path_dict.keys():
-        multibursts += get_multibursts_path(path_dict[path])
+        multiburst_dicts += _plan_path(path_dict[path], set_cost)
+    return _validate_multibursts(multiburst_dicts, max_workers, multiburst_class, use_cache)
 
-    return multibursts
-
-def get_multibursts_path(burst_ids):
+def _plan_path(burst_ids, set_cost = 3):
     """
-    Get Multiburst objects from a list of burst ids from one path.
+    Partitions the bursts of one path in multiburst sets with the cheapest plan from plan_multiburst.
     
     Args:
         burst_ids: List with the burst IDs associated with a path.
+        set_cost: Cost of a multiburst set measured in bursts.
     
     Returns:
-        multibursts: List of Multiburst objects associated with the burst IDs.
+        multiburst_dicts: List of multiburst dictionaries.
     """
     multiburst_dict = dict()
     for bid in burst_ids:
-        path = bid[0:3]
         id = bid[0:-4]
         swath = bid[-3::]
         if not id in multiburst_dict.keys():
             multiburst_dict[id] = (swath,)
         else:
             multiburst_dict[id] = tuple(sorted(multiburst_dict[id] + (swath,)))
+    return plan_multiburst(multiburst_dict, set_cost=set_cost)[0]['multiburst_dicts']
 
-    try:
-        multiburst = get_multiburst(multiburst_dict)
-        return [multiburst]
-    except InvalidMultiBurstCountError:
-        cont = 0
-        multiburst_dicts = []
-        multiburst_set = dict()
-        for bid in sorted(multiburst_dict.keys()):
-            if (cont + len(multiburst_dict[bid])) > 30:
-                multiburst_dicts.append(multiburst_set)
-                multiburst_set = dict()
-                cont = 0
-            multiburst_set[bid] = multiburst_dict[bid]
-            cont += len(multiburst_dict[bid])
-        if cont > 0:
-            multiburst_dicts.append(multiburst_set)
-    except InvalidMultiBurstTopologyError:
-        multiburst_dicts = [multiburst_dict]
-    multibursts = []
-    for multiburst_dict in multiburst_dicts:
-        try:
-            multiburst = get_multiburst(multiburst_dict)
-            multibursts.append(multiburst)
-        except InvalidMultiBurstTopologyError:
-            multibursts_sets = split_multiburst(multiburst_dict)
-            for multiburst_dict in multibursts_sets:
-                multibursts.append(get_multiburst(multiburst_dict))
-
-    return multibursts
+def _validate_multibursts(multiburst_dicts, max_workers, multiburst_class, use_cache):
+    """
+    Creates the Multiburst objects of several multiburst sets concurrently.
+    
+    Args:
+        multiburst_dicts: List of multiburst dictionaries.
+        max_workers: Maximum number of multiburst sets validated concurrently.
+        multiburst_class: Class used to create and validate the multiburst sets.
+        use_cache: If True it reads and writes the cache of validated multiburst sets.
+    
+    Returns:
+        multibursts: List of Multiburst objects.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda multiburst_dict: get_multiburst(multiburst_dict, use_cache, multiburst_class), multiburst_dicts))
 
-def get_multiburst(multiburst_dict):
-    try:
-        multiburst = asf.MultiBurst(multiburst_dict)
-    except InvalidMultiBurstTopologyError as e:
-        raise(e)
-    except InvalidMultiBurstCountError as e:
-        raise(e)
-    except ConnectionError:
-        time.sleep(5)
-        multiburst = asf.MultiBurst(multiburst_dict)
-    except ConnectionResetError:
-        time.sleep(5)
-        multiburst = asf.MultiBurst(multiburst_dict)
-    except OSError as e:
-        time.sleep(5)
-        multiburst = asf.MultiBurst(multiburst_dict)
-    return multiburst
+def get_multibursts_path(burst_ids, max_workers = 4, set_cost = 3, multiburst_class = asf.MultiBurst, use_cache = True):
+    """
+    Get Multiburst objects from a list of burst ids from one path.
+    
+    The bursts are partitioned offline with the cheapest plan from plan_multiburst before validating them.
+    
+    Args:
+        burst_ids: List with the burst IDs associated with a path.
+        max_workers: Maximum number of multiburst sets validated concurrently.
+        set_cost: Cost of a multiburst set measured in bursts, used to choose how to split the bursts.
+        multiburst_class: Class used to create and validate the multiburst sets.
+        use_cache: If True it reads and writes the cache of validated multiburst sets.
+    
+    Returns:
+        multibursts: List of Multiburst objects associated with the burst IDs.
+    """
+    return _validate_multibursts(_plan_path(burst_ids, set_cost), max_workers, multiburst_class, use_cache)
 
-def split_count(multiburst_dict):
+def get_multiburst(multiburst_dict, use_cache = True, multiburst_class = asf.MultiBurst):
     """
-    Splits a multiburst set in case it is over 30 bursts.
+    Creates a Multiburst object, retrying with exponential backoff on connection errors.
+    
+    The result of the validation (the Multiburst object or the topology/count error) is cached in memory and in
+    MULTIBURST_CACHE, keyed by the canonical multiburst dictionary and the class, so repeated calls skip the validation.
     
     Args:
         multiburst_dict: Dictionary where the keys are burst IDs and the elements are the swaths.
+        use_cache: If True it reads and writes the cache.
+        multiburst_class: Class used to create and validate the multiburst set.
     
     Returns:
-        multiburst_dicts: List of the splitted dictionary.
+        multiburst: Multiburst object.
     """
-    cont = 0
-    multiburst_dicts = []
-    multiburst_set = dict()
-    for bid in sorted(multiburst_dict.keys()):
-        if (cont + len(multiburst_dict[bid])) > 30:
-            multiburst_dicts.append(multiburst_set)
-            multiburst_set = dict()
-            cont = 0
-        multiburst_set[bid] = multiburst_dict[bid]
-        cont += len(multiburst_dict[bid])
-    if cont > 0:
-        multiburst_dicts.append(multiburst_set)
-
-    return multiburst_dicts
+    canonical = json.dumps({'class': f'{multiburst_class.__module__}.{multiburst_class.__qualname__}',
+                            'multiburst': {bid: sorted(swaths) for bid, swaths in multiburst_dict.items()}}, sort_keys=True)
+    key = hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+    cache_file = MULTIBURST_CACHE / f'{key}.pkl'
+    if use_cache and key not in _multiburst_cache.keys() and cache_file.exists():
+        try:
+            with open(cache_file, 'rb') as f:
+                _multiburst_cache[key] = pickle.load(f)
+        except (pickle.UnpicklingError, EOFError):
+            cache_file.unlink(missing_ok=True)
+    if use_cache and key in _multiburst_cache.keys():
+        result = _multiburst_cache[key]
+    else:
+        try:
+            result = call_with_retries(multiburst_class, multiburst_dict, retries=3, backoff=5)
+        except (InvalidMultiBurstTopologyError, InvalidMultiBurstCountError) as e:
+            result = e
+        if use_cache:
+            _multiburst_cache[key] = result
+            temp = MULTIBURST_CACHE / f'.{cache_file.name}.{os.getpid()}.{threading.get_ident()}'
+            try:
+                MULTIBURST_CACHE.mkdir(parents=True, exist_ok=True)
+                with open(temp, 'wb') as f:
+                    pickle.dump(result, f)
+                os.replace(temp, cache_file)
+            except (pickle.PicklingError, TypeError, AttributeError):
+                temp.unlink(missing_ok=True)
+    if isinstance(result, Exception):
+        raise type(result)(*result.args)
+    return result
 
-def split_multiburst(multiburst_dict):
+def multiburst_to_grid(multiburst_dict):
     """
-    Splits a multiburst horizontally or vertically and fill holes if it doesn't meet burst2safe standards.
+    Converts a multiburst set of one path to an occupancy grid.
     
     Args:
         multiburst_dict: Dictionary where the keys are burst IDs and the elements are the swaths.
     
     Returns:
-        new_sets: List of the splitted dictionary.
+        grid: Tuple with the path, the first burst number and a boolean array with dimensions
+              (burst number, swath) that is True where the burst is in the set.
     """
-    new_dicts = split_vertical_multiburst(multiburst_dict)
-    new_sets = []
-    for new_dict in new_dicts:
-        new_dict = fill_holes(new_dict)
-        new_set = complete_sides(new_dict)
-        for new_dict in new_set:
-            new_sets += split_horizontal_multiburst(new_dict)
+    path = next(iter(multiburst_dict.keys()))[0:3]
+    rows = []
+    columns = []
+    for bid, swaths in multiburst_dict.items():
+        number = int(bid[4:])
+        for swath in swaths:
+            rows.append(number)
+            columns.append(SWATHS.index(swath))
+    rows = np.array(rows)
+    first = int(rows.min())
+    occupancy = np.zeros((rows.max() - first + 1, len(SWATHS)), dtype=bool)
+    occupancy[rows - first, columns] = True
+    return (path, first, occupancy)
 
-    return new_sets
-
-def split_vertical_multiburst(multiburst_dict):
+def grid_to_multiburst(grid):
     """
-    Splits a multiburst vertically if it finds a vertical gap in the set.
+    Converts an occupancy grid to a multiburst set.
     
     Args:
+        grid: Tuple with the path, the first burst number and the occupancy array.
+    
+    Returns:
         multiburst_dict: Dictionary where the keys are burst IDs and the elements are the swaths.
+    """
+    path, first, occupancy = grid
+    codes = occupancy @ (1 << np.arange(len(SWATHS)))
+    rows = np.flatnonzero(codes)
+    return {f'{path}_{first + row:06d}': SWATH_COMBINATIONS[code] for row, code in zip(rows.tolist(), codes[rows].tolist())}
+
+def get_grid_ranges(occupancy):
+    """
+    Finds the first and last burst of each swath in an occupancy array.
+    
+    Args:
+        occupancy: Boolean array with dimensions (burst number, swath).
     
     Returns:
-        new_sets: List of the splitted dictionary.
+        present: Boolean array that is True for the swaths with bursts.
+        starts: First row of each swath.
+        ends: Last row of each swath.
     """
-    ids = [bid for bid in sorted(multiburst_dict.keys())]
-    id_sets=[]
-    previous = 0
-    for i,id in enumerate(ids[0:-1]):
-        current = int(id.split('_')[1])
-        next = int(ids[i+1].split('_')[1])
-        if not current == (next-1):
-            id_sets.append(ids[previous:(i+1)])
-            previous = i+1
-    id_sets.append(ids[previous::])
-    new_sets=[]
-    for id_set in id_sets:
-        new_dict=dict()
-        for bid in id_set:
-            new_dict[bid] = multiburst_dict[bid]
-        new_sets.append(new_dict)
-    return new_sets
+    present = occupancy.any(axis=0)
+    starts = np.argmax(occupancy, axis=0)
+    ends = occupancy.shape[0] - 1 - np.argmax(occupancy[::-1], axis=0)
+    return present, starts, ends
 
-def fill_holes(multiburst_dict):
+def is_valid_grid(occupancy):
     """
-    Fills a multiburst set when a hole is found in the set.
+    Checks if an occupancy array is a valid multiburst set.
+    
+    A valid set has at most MAX_BURSTS bursts, adjacent swaths, no holes within a swath and
+    the first and last bursts of adjacent swaths differ by at most one burst.
     
     Args:
-        multiburst_dict: Dictionary where the keys are burst IDs and the elements are the swaths.
+        occupancy: Boolean array with dimensions (burst number, swath).
     
     Returns:
-        multiburst_dict: Dictionary with complemented set.
-    """
-    for bid in multiburst_dict.keys():
-        if "IW1" in multiburst_dict[bid] and "IW3" in multiburst_dict[bid] and not "IW2" in multiburst_dict[bid]:
-            multiburst_dict[bid] = tuple(sorted(multiburst_dict[bid] + ("IW2",)))
-    ranges = dict()
-    for swath in ["IW1","IW2","IW3"]:
-        ids = sorted(list(set([bid for bid in multiburst_dict.keys() if swath in multiburst_dict[bid]])))
-        if len(ids) > 0:
-            ranges[swath] = (int(ids[0].split('_')[1]), int(ids[-1].split('_')[1]))
-            dif = abs(int(ids[0].split('_')[1])-int(ids[-1].split('_')[1]))
-            if not dif == (len(ids)-1):
-                for i,id in enumerate(ids[0:-1]):
-                    current = int(id.split('_')[1])
-                    next = int(ids[i+1].split('_')[1])
-                    if not current == next-1:
-                        for j in range(current+1, next):
-                            multiburst_dict[id[0:4]+str(j)] = tuple(sorted(multiburst_dict[id[0:4]+str(j)] +(swath,)))
-    return multiburst_dict
+        valid: True if the set is valid.
+    """
+    count = occupancy.sum()
+    if count == 0 or count > MAX_BURSTS:
+        return False
+    present, starts, ends = get_grid_ranges(occupancy)
+    columns = np.flatnonzero(present)
+    if columns[-1] - columns[0] + 1 != len(columns):
+        return False
+    if np.any(occupancy.sum(axis=0)[columns] != ends[columns] - starts[columns] + 1):
+        return False
+    return bool(np.all(np.abs(np.diff(starts[columns])) <= 1) and np.all(np.abs(np.diff(ends[columns])) <= 1))
 
+def split_vertical_grid(grid):
+    """
+    Splits an occupancy grid where there are burst numbers without bursts.
+    
+    Args:
+        grid: Tuple with the path, the first burst number and the occupancy array.
+    
+    Returns:
+        grids: List of grids without vertical gaps.
+    """
+    path, first, occupancy = grid
+    rows = np.concatenate(([False], occupancy.any(axis=1), [False])).astype(np.int8)
+    changes = np.diff(rows)
+    starts = np.flatnonzero(changes == 1)
+    ends = np.flatnonzero(changes == -1)
+    return [(path, first + start, occupancy[start:end]) for start, end in zip(starts, ends)]
 
-def get_ranges(multiburst_dict):
+def fill_holes_grid(occupancy):
     """
-    Finds the ranges for each swath in a multiburst set.
+    Fills the holes in an occupancy array.
+    
+    IW2 is added where a burst has IW1 and IW3, and each swath is filled between its first and last burst.
     
     Args:
-        multiburst_dict: Dictionary where the keys are burst IDs and the elements are the swaths.
+        occupancy: Boolean array with dimensions (burst number, swath).
     
     Returns:
-        ranges: Tuple with the initial and final burst.
-        ids: List of burst IDs in the multiburst set.
-    """
-    ranges = dict()
-    ids = dict()
-    swaths = ["IW1","IW2","IW3"]
-    for swath in swaths:
-        ids[swath] = sorted(list(set([bid for bid in multiburst_dict.keys() if swath in multiburst_dict[bid]])))
-        if len(ids[swath]) > 0:
-            ranges[swath] = (int(ids[swath][0].split('_')[1]), int(ids[swath][-1].split('_')[1]))
-    return ranges, ids
+        occupancy: Boolean array without holes.
+    """
+    occupancy = occupancy.copy()
+    occupancy[:, 1] |= occupancy[:, 0] & occupancy[:, 2]
+    before_first = np.logical_and.accumulate(~occupancy, axis=0)
+    after_last = np.logical_and.accumulate(~occupancy[::-1], axis=0)[::-1]
+    occupancy |= ~before_first & ~after_last
+    return occupancy
 
-def complete_sides(multiburst_dict):
+def complete_sides_grid(occupancy):
     """
-    Adds bursts to a multiburst set in case the ranges between adjacent swaths is more than 1 and less than 3.
+    Adds bursts where the first or last bursts of adjacent swaths differ by 2 or 3 bursts.
     
     Args:
-        multiburst_dict: Dictionary where the keys are burst IDs and the elements are the swaths.
+        occupancy: Boolean array with dimensions (burst number, swath).
     
     Returns:
-        multiburst_dicts: List of complemented multiburst sets.
-    """
-    swaths = ["IW1","IW2","IW3"]
-    for i in range(3):
-        ranges, ids = get_ranges(multiburst_dict)
-        if i == 2:
-           i = 0
-        current = swaths[i]
-        next = swaths[i+1]
-        if not current in ranges.keys() or not next in ranges.keys():
+        occupancy: Boolean array with the completed sides.
+    """
+    occupancy = occupancy.copy()
+    for current, next in [(0, 1), (1, 2), (0, 1)]:
+        present, starts, ends = get_grid_ranges(occupancy)
+        if not present[current] or not present[next]:
             continue
-        path = ids[current][0][0:3]
-        split = abs(ranges[current][0]-ranges[next][0]) > 3 or abs(ranges[current][1]-ranges[next][1]) > 3
-        valid = abs(ranges[current][0]-ranges[next][0]) <= 1 and abs(ranges[current][1]-ranges[next][1]) <= 1 
-        if split or valid:
+        start_dif = abs(starts[current] - starts[next])
+        end_dif = abs(ends[current] - ends[next])
+        if start_dif > 3 or end_dif > 3 or (start_dif <= 1 and end_dif <= 1):
             continue
+        if start_dif > 1:
+            if starts[current] > starts[next]:
+                occupancy[starts[next]+1:starts[current], current] = True
+            else:
+                occupancy[starts[current]+1:starts[next], next] = True
+        if end_dif > 1:
+            if ends[current] > ends[next]:
+                occupancy[ends[next]+1:ends[current], next] = True
+            else:
+                occupancy[ends[current]+1:ends[next], current] = True
+    return occupancy
+
+def split_count_grid(grid):
+    """
+    Splits an occupancy grid in sets of consecutive burst numbers with at most MAX_BURSTS bursts.
+    
+    Args:
+        grid: Tuple with the path, the first burst number and the occupancy array.
+    
+    Returns:
+        grids: List of grids with at most MAX_BURSTS bursts.
+    """
+    path, first, occupancy = grid
+    grids = []
+    start = 0
+    count = 0
+    for row, row_count in enumerate(occupancy.sum(axis=1)):
+        if count + row_count > MAX_BURSTS:
+            grids.append((path, first + start, occupancy[start:row]))
+            start = row
+            count = 0
+        count += row_count
+    if count > 0:
+        grids.append((path, first + start, occupancy[start:]))
+    return grids
+
+def split_horizontal_grid(grid):
+    """
+    Splits an occupancy grid by swaths where adjacent swaths are not contiguous or their
+    first or last bursts differ by more than one burst.
+    
+    Args:
+        grid: Tuple with the path, the first burst number and the occupancy array.
+    
+    Returns:
+        grids: List of grids with the groups of swaths.
+    """
+    path, first, occupancy = grid
+    present, starts, ends = get_grid_ranges(occupancy)
+    groups = []
+    for column in np.flatnonzero(present):
+        previous = column - 1
+        if (len(groups) > 0 and groups[-1][-1] == previous
+                and abs(starts[column] - starts[previous]) <= 1 and abs(ends[column] - ends[previous]) <= 1):
+            groups[-1].append(column)
         else:
-            if abs(ranges[current][0]-ranges[next][0]) > 1:
-                if ranges[current][0] > ranges[next][0]:
-                    for id in range(ranges[next][0]+1, ranges[current][0]):
-                        bid = path+'_'+str(id).zfill(6)
-                        multiburst_dict[bid] = tuple(sorted(multiburst_dict[bid] +(current,)))
-                else:
-                    for id in range(ranges[current][0]+1, ranges[next][0]):
-                        bid = path+'_'+str(id).zfill(6)
-                        multiburst_dict[bid] = tuple(sorted(multiburst_dict[bid] +(next,)))
-            if abs(ranges[current][1]-ranges[next][1]) > 1:
-                if ranges[current][1] > ranges[next][1]:
-                    for id in range(ranges[next][1]+1, ranges[current][1]):                
-                        bid = path+'_'+str(id).zfill(6)
-                        multiburst_dict[bid] = tuple(sorted(multiburst_dict[bid] +(next,)))
-                else:
-                    for id in range(ranges[current][1]+1, ranges[next][1]):
-                        bid = path+'_'+str(id).zfill(6)
-                        multiburst_dict[bid] = tuple(sorted(multiburst_dict[bid] +(current,)))
-    multiburst_dicts = split_count(multiburst_dict)
-    return multiburst_dicts
+            groups.append([column])
+    grids = []
+    for group in groups:
+        new_occupancy = np.zeros_like(occupancy)
+        new_occupancy[:, group] = occupancy[:, group]
+        grids.append((path, first, new_occupancy))
+    return grids
+
+def partition_grid(grid):
+    """
+    Partitions an occupancy grid in valid multiburst sets.
+    
+    Args:
+        grid: Tuple with the path, the first burst number and the occupancy array.
+    
+    Returns:
+        grids: List of grids that are valid multiburst sets.
+    """
+    if is_valid_grid(grid[2]):
+        return [grid]
+    grids = []
+    for path, first, occupancy in split_vertical_grid(grid):
+        if is_valid_grid(occupancy):
+            grids.append((path, first, occupancy))
+            continue
+        occupancy = complete_sides_grid(fill_holes_grid(occupancy))
+        for count_grid in split_count_grid((path, first, occupancy)):
+            grids += split_horizontal_grid(count_grid)
+    return grids
+
+def get_group_shape(starts, ends, group):
+    """
+    Finds the smallest valid shape of a group of adjacent swaths covering the requested bursts.
+    
+    Args:
+        starts: First requested row of each swath, None if the swath has no requested bursts.
+        ends: Last requested row of each swath, None if the swath has no requested bursts.
+        group: Tuple with the adjacent swath indices of the group.
+    
+    Returns:
+        shape: List with the (first row, last row) of each swath in the group, None if no valid shape exists.
+    """
+    requested = [column for column in group if starts[column] is not None]
+    shape = dict()
+    for column in group:
+        # adjacent swaths can differ by one burst at each end
+        start = min(starts[other] + abs(column - other) for other in requested)
+        end = max(ends[other] - abs(column - other) for other in requested)
+        shape[column] = (start, end)
+    inverted = [column for column in group if shape[column][0] > shape[column][1]]
+    if len(inverted) == 0:
+        return [shape[column] for column in group]
+
+    # swaths without requested bursts whose ranges invert get one burst within one row of the swaths
+    # next to them, fixing first the ones closest to the requested swaths
+    first = min(starts[column] for column in requested)
+    last = max(ends[column] for column in requested)
+    for column in sorted(inverted, key=lambda column: min(abs(column - other) for other in requested)):
+        neighbors = [shape[other] for other in (column - 1, column + 1) if other in shape.keys() and other not in inverted]
+        low = max([first] + [neighbor_end - 1 for _, neighbor_end in neighbors])
+        high = min([last] + [neighbor_start + 1 for neighbor_start, _ in neighbors])
+        if low > high:
+            return None
+        row = int(np.clip(shape[column][1], low, high))
+        shape[column] = (row, row)
+        inverted.remove(column)
+    shape = [shape[column] for column in group]
+    if any(abs(a[0] - b[0]) > 1 or abs(a[1] - b[1]) > 1 for a, b in zip(shape[:-1], shape[1:])):
+        return None
+    return shape
+
+def optimize_grid(grid, set_cost = 3):
+    """
+    Finds the partition of an occupancy grid in valid multiburst sets that minimizes the number of processed
+    bursts plus set_cost for each set.
+    
+    The rows are split in bands with dynamic programming. In each band the swaths are grouped in one of the
+    possible groupings of adjacent swaths, and each group is the smallest valid set covering its requested bursts.
+    
+    Args:
+        grid: Tuple with the path, the first burst number and the occupancy array with the requested bursts.
+        set_cost: Cost of a multiburst set measured in bursts.
+    
+    Returns:
+        grids: List of grids that are valid multiburst sets and cover the requested bursts.
+    """
+    path, first, occupancy = grid
+    rows, columns = occupancy.shape
+    next_requested = np.full((rows + 1, columns), rows)
+    previous_requested = np.full((rows + 1, columns), -1)
+    for row in range(rows - 1, -1, -1):
+        next_requested[row] = np.where(occupancy[row], row, next_requested[row + 1])
+    for row in range(rows):
+        previous_requested[row + 1] = np.where(occupancy[row], row, previous_requested[row])
+    next_requested = next_requested.tolist()
+    previous_requested = previous_requested.tolist()
+
+    best = [0.0] + [np.inf]*rows
+    choices = [None]*(rows + 1)
+    for end in range(1, rows + 1):
+        for start in range(end - 1, max(0, end - MAX_BURSTS) - 1, -1):
+            if best[start] == np.inf:
+                continue
+            starts = [row if row < end else None for row in next_requested[start]]
+            ends = [row if row >= start else None for row in previous_requested[end]]
+            if any(row is not None and ends[column] - row + 1 > MAX_BURSTS for column, row in enumerate(starts)):
+                break
+            groups = dict()
+            for group in SWATH_GROUPS:
+                if all(starts[column] is None for column in group):
+                    groups[group] = (0, None)
+                    continue
+                shape = get_group_shape(starts, ends, group)
+                bursts = np.inf if shape is None else sum(last - first_row + 1 for first_row, last in shape)
+                groups[group] = (np.inf, None) if bursts > MAX_BURSTS else (bursts + set_cost, shape)
+            for grouping in SWATH_GROUPINGS:
+                cost = best[start] + sum(groups[group][0] for group in grouping)
+                if cost < best[end]:
+                    best[end] = cost
+                    choices[end] = (start, [(group, groups[group][1]) for group in grouping if groups[group][1] is not None])
 
-def split_horizontal_multiburst(multiburst_dict):
+    grids = []
+    end = rows
+    while end > 0:
+        start, shapes = choices[end]
+        for group, shape in shapes:
+            new_occupancy = np.zeros((end - start, columns), dtype=bool)
+            for column, (first_row, last) in zip(group, shape):
+                new_occupancy[first_row - start:last - start + 1, column] = True
+            grids.append((path, first + start, new_occupancy))
+        end = start
+    return grids[::-1]
+
+def plan_multiburst(multiburst_dict, set_cost = 3):
     """
-    Splits a multiburst set horizontally in case the difference between adjacent ranges swaths is more than 1.
+    Compares plans to split a multiburst set in valid sets.
+    
+    The candidate plans are the heuristic split (split_multiburst) and the optimal partitions that minimize
+    the processed bursts, the number of sets or the cost with set_cost.
     
     Args:
         multiburst_dict: Dictionary where the keys are burst IDs and the elements are the swaths.
+        set_cost: Cost of a multiburst set measured in bursts.
     
     Returns:
-        multiburst_dicts: List with the splitted multiburst set.
+        plans: List of dictionaries sorted by cost with the name of the plan, the multiburst sets, the number of
+               sets, the number of processed bursts, the number of bursts added to the request and the cost.
     """
-    ranges, ids = get_ranges(multiburst_dict)
+    grid = multiburst_to_grid(multiburst_dict)
+    requested = int(grid[2].sum())
+    candidates = {
+        'heuristic': partition_grid(grid),
+        'min_bursts': optimize_grid(grid, set_cost=1e-3),
+        'min_sets': optimize_grid(grid, set_cost=MAX_BURSTS*grid[2].size),
+        'min_cost': optimize_grid(grid, set_cost=set_cost),
+    }
+    plans = []
+    for name, grids in candidates.items():
+        bursts = int(sum(occupancy.sum() for _, _, occupancy in grids))
+        plans.append({
+            'name': name,
+            'multiburst_dicts': [grid_to_multiburst(grid) for grid in grids],
+            'sets': len(grids),
+            'bursts': bursts,
+            'added_bursts': bursts - requested,
+            'cost': bursts + set_cost*len(grids),
+        })
+    return sorted(plans, key=lambda plan: plan['cost'])
+
+def split_count(multiburst_dict):
+    """
+    Splits a multiburst set in case it is over 30 bursts.
     
-    if not "IW1" in ranges.keys() or not "IW2" in ranges.keys():
-        split12 = False
-    else:
-        split12 = abs(ranges["IW1"][0]-ranges["IW2"][0]) > 1 or abs(ranges["IW1"][1]-ranges["IW2"][1]) > 1    
-    if not "IW2" in ranges.keys() or not "IW3" in ranges.keys():
-        split23 = False
-    else:
-        split23 = abs(ranges["IW2"][0]-ranges["IW3"][0]) > 1 or abs(ranges["IW2"][1]-ranges["IW3"][1]) > 1
-    if split12 and split23:
-        iw1 = dict()
-        iw2 = dict()
-        iw3 = dict()
-        for bid in multiburst_dict.keys():
-            swaths = multiburst_dict[bid]
-            if "IW1" in swaths:
-                iw1[bid] = ("IW1",)
-            if "IW2" in swaths:
-                iw2[bid] = ("IW2",)
-            if "IW3" in swaths:
-                iw3[bid] = ("IW3",)
-        return [iw1, iw2, iw3]
-    elif split12:
-        iw1 = dict()
-        rest = dict()
-        for bid in multiburst_dict.keys():
-            swaths = multiburst_dict[bid]
-            if "IW1" in swaths:
-                iw1[bid] = ("IW1",)
-            if "IW2" in swaths:
-                if bid in rest.keys():
-                    rest[bid] = tuple(sorted(rest[bid] + ("IW2",)))
-                else:
-                    rest[bid] = ("IW2",)
-            if "IW3" in swaths:
-                if bid in rest.keys():
-                    rest[bid] = tuple(sorted(rest[bid] + ("IW3",)))
-                else:
-                    rest[bid] = ("IW3",)
-        return [iw1, rest]
-    elif split23:
-        iw3 = dict()
-        rest = dict()
-        for bid in multiburst_dict.keys():
-            swaths = multiburst_dict[bid]
-            if "IW3" in swaths:
-                iw3[bid] = ("IW3",)
-            if "IW1" in swaths:
-                if bid in rest.keys():
-                    rest[bid] = tuple(sorted(rest[bid] + ("IW1",)))
-                else:
-                    rest[bid] = ("IW1",)
-            if "IW2" in swaths:
-                if bid in rest.keys():
-                    rest[bid] = tuple(sorted(rest[bid] + ("IW2",)))
-                else:
-                    rest[bid] = ("IW2",)
-        return [rest, iw3]
-    else:
-        return [multiburst_dict]
+    Args:
+        multiburst_dict: Dictionary where the keys are burst IDs and the elements are the swaths.
+    
+    Returns:
+        multiburst_dicts: List of the splitted dictionary.
+    """
+    return [grid_to_multiburst(grid) for grid in split_count_grid(multiburst_to_grid(multiburst_dict))]
 
+def split_multiburst(multiburst_dict):
+    """
+    Splits a multiburst horizontally or vertically and fill holes if it doesn't meet burst2safe standards.
+    
+    Args:
+        multiburst_dict: Dictionary where the keys are burst IDs and the elements are the swaths.
+    
+    Returns:
+        new_sets: List of the splitted dictionary.
+    """
+    return [grid_to_multiburst(grid) for grid in partition_grid(multiburst_to_grid(multiburst_dict))]
@@ -0,0 +1,28 @@
+import random
+import time
+
+
+def call_with_retries(func, *args, retries = 3, backoff = 1, exceptions = (ConnectionError, OSError), retry_if = None, **kwargs):
+    """
+    Calls a function retrying with exponential backoff and jitter when it raises a connection error.
+    
+    Args:
+        func: Function to call.
+        args: Positional arguments for the function.
+        retries: Number of retries after the first attempt.
+        backoff: Base waiting time in seconds. The wait before retry n is random between 0 and backoff*2**n.
+        exceptions: Exceptions that trigger a retry.
+        retry_if: Function that takes the exception raised and returns True if it should be retried. If None
+                  all the exceptions in exceptions are retried.
+        kwargs: Keyword arguments for the function.
+    
+    Returns:
+        result: The value returned by the function.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except exceptions as e:
+            if attempt == retries or (retry_if is not None and not retry_if(e)):
+                raise
+            time.sleep(random.uniform(0, backoff * 2**attempt))
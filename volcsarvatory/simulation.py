@@ -0,0 +1,266 @@
+import asf_search as asf
+import json
+import numpy as np
+import random
+import threading
+import time
+import uuid
+
+from asf_search.exceptions import InvalidMultiBurstCountError, InvalidMultiBurstTopologyError
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from volcsarvatory import aoi, pairs
+from volcsarvatory import prepare_multibursts as pm
+
+
+class FixtureProduct:
+    """
+    Stand-in for an ASFProduct with the properties recorded in a fixture.
+    """
+    def __init__(self, properties):
+        self.properties = properties
+
+
+class FixtureMultiBurst:
+    """
+    Stand-in for asf_search.MultiBurst that validates the topology of the set offline.
+    """
+    def __init__(self, multiburst_dict):
+        occupancy = pm.multiburst_to_grid(multiburst_dict)[2]
+        if occupancy.sum() > pm.MAX_BURSTS:
+            raise InvalidMultiBurstCountError(f'The multiburst set has more than {pm.MAX_BURSTS} bursts')
+        if not pm.is_valid_grid(occupancy):
+            raise InvalidMultiBurstTopologyError('The multiburst set has an invalid topology')
+        self.multiburst_dict = multiburst_dict
+
+
+class FixtureJob:
+    """
+    Stand-in for a hyp3_sdk.Job.
+    """
+    def __init__(self, job_id, job_type, job_parameters, name = None, status_code = 'PENDING'):
+        self.job_id = job_id
+        self.job_type = job_type
+        self.job_parameters = job_parameters
+        self.name = name
+        self.status_code = status_code
+
+    def succeeded(self):
+        return self.status_code == 'SUCCEEDED'
+
+    def failed(self):
+        return self.status_code == 'FAILED'
+
+
+class FixtureHyP3:
+    """
+    Stand-in for hyp3_sdk.HyP3 that keeps the prepared and submitted jobs in memory.
+
+    The first `failures` submissions raise a ConnectionError, to exercise the retries of pairs.submit_jobs.
+    The next `lost_responses` submissions create the jobs and then raise a ConnectionError, as when the
+    response of an accepted submission is lost.
+    """
+    def __init__(self, failures = 0, lost_responses = 0):
+        self.submitted = []
+        self.failures = failures
+        self.lost_responses = lost_responses
+        self.lock = threading.Lock()
+
+    def prepare_insar_isce_multi_burst_job(self, reference, secondary, name = None, apply_water_mask = False, **kwargs):
+        job = {
+            'job_type': 'INSAR_ISCE_MULTI_BURST',
+            'job_parameters': {'reference': list(reference), 'secondary': list(secondary), 'apply_water_mask': apply_water_mask, **kwargs},
+        }
+        if name is not None:
+            job['name'] = name
+        return job
+
+    def submit_prepared_jobs(self, prepared_jobs):
+        with self.lock:
+            if self.failures > 0:
+                self.failures -= 1
+                raise ConnectionError('Simulated connection error')
+        jobs = []
+        for job in prepared_jobs:
+            job_id = str(uuid.uuid5(uuid.NAMESPACE_URL, json.dumps(job, sort_keys=True)))
+            jobs.append(FixtureJob(job_id, job['job_type'], job['job_parameters'], name=job.get('name')))
+        with self.lock:
+            self.submitted += jobs
+            if self.lost_responses > 0:
+                self.lost_responses -= 1
+                raise ConnectionError('Simulated lost response')
+        return jobs
+
+    def find_jobs(self, name = None, **kwargs):
+        return [job for job in self.submitted if name is None or job.name == name]
+
+
+class Fixtures:
+    """
+    Recorded search results and coherence estimates used to run the pipeline offline.
+
+    The fixture file is a JSON file with the keys 'search' (dictionary where the keys are full burst ids and the
+    elements are lists with the properties of the products) and 'coherence' (dictionary where the keys are
+    'reference scene/secondary scene' and the elements are the mean coherence).
+    """
+    def __init__(self, fixture_file = None):
+        self.fixture_file = fixture_file
+        self.products = dict()
+        self.coherence = dict()
+        if fixture_file is not None and Path(fixture_file).exists():
+            with open(fixture_file) as f:
+                fixtures = json.load(f)
+            self.products = fixtures.get('search', dict())
+            self.coherence = fixtures.get('coherence', dict())
+
+    def save(self, fixture_file = None):
+        """
+        Writes the fixtures to a JSON file.
+
+        Args:
+            fixture_file: Path to the JSON file. If None it uses the file the fixtures were loaded from.
+        """
+        fixture_file = self.fixture_file if fixture_file is None else fixture_file
+        with open(fixture_file, 'w') as f:
+            json.dump({'search': self.products, 'coherence': self.coherence}, f)
+
+    def search(self, fullBurstID = None, start = None, end = None, **kwargs):
+        """
+        Stand-in for asf_search.search that returns the recorded products of the burst ids, newest first.
+        """
+        bids = [fullBurstID] if isinstance(fullBurstID, str) else list(fullBurstID)
+        products = []
+        for bid in bids:
+            for properties in self.products.get(bid, []):
+                stop = properties['stopTime'] or properties['startTime']
+                if start is not None and stop < str(start):
+                    continue
+                if end is not None and stop > str(end):
+                    continue
+                products.append(FixtureProduct(properties))
+        return sorted(products, key=lambda product: product.properties['startTime'], reverse=True)
+
+    def pair(self, ref, sec):
+        """
+        Stand-in for asf_search.Pair that returns the recorded coherence of the pair.
+        """
+        return FixturePair(ref, sec, self.coherence)
+
+
+class FixturePair:
+    """
+    Stand-in for asf_search.Pair. Pairs without a recorded coherence get a deterministic estimate
+    that decays with the temporal baseline.
+    """
+    def __init__(self, ref, sec, coherence = None):
+        self.ref = ref
+        self.sec = sec
+        self.coherence = dict() if coherence is None else coherence
+        ref_time = datetime.fromisoformat(ref.properties['startTime'].replace('Z', '+00:00'))
+        sec_time = datetime.fromisoformat(sec.properties['startTime'].replace('Z', '+00:00'))
+        self.temporal_baseline = sec_time.date() - ref_time.date()
+
+    def estimate_s1_mean_coherence(self):
+        key = f"{self.ref.properties['sceneName']}/{self.sec.properties['sceneName']}"
+        if key in self.coherence.keys():
+            return self.coherence[key]
+        return float(0.2 + 0.6*np.exp(-abs(self.temporal_baseline.days)/24))
+
+
+def record_fixtures(burst_ids, fixture_file, search = asf.search):
+    """
+    Records the live search results of burst ids in a fixture file.
+
+    Args:
+        burst_ids: List of full burst ids.
+        fixture_file: Path to the JSON fixture file. Existing fixtures are kept.
+        search: Search function with the same interface as asf_search.search.
+
+    Returns:
+        fixtures: Fixtures with the recorded products.
+    """
+    fixtures = Fixtures(fixture_file)
+    for bid in burst_ids:
+        fixtures.products[bid] = [dict(product.properties) for product in search(fullBurstID=bid)]
+    fixtures.save(fixture_file)
+    return fixtures
+
+
+def get_sequential_pairs(multiburst, search, num_neighbors = 2):
+    """
+    Makes a simple network connecting each acquisition of a multiburst set with the next ones.
+
+    Args:
+        multiburst: Multiburst object.
+        search: Search function with the same interface as asf_search.search.
+        num_neighbors: Number of following acquisitions connected to each acquisition.
+
+    Returns:
+        refs: Reference scene ids sorted by burst.
+        secs: Secondary scene ids sorted by burst.
+    """
+    refs = []
+    secs = []
+    scenes = dict()
+    for bid, swaths in multiburst.multiburst_dict.items():
+        for swath in swaths:
+            scenes[bid+'_'+swath] = {product.properties['startTime'][0:10]: product.properties['sceneName']
+                                     for product in search(fullBurstID=bid+'_'+swath)}
+    dates = sorted(set.intersection(*[set(burst_scenes.keys()) for burst_scenes in scenes.values()]))
+    for burst_scenes in scenes.values():
+        for i, ref in enumerate(dates):
+            for sec in dates[i+1:i+1+num_neighbors]:
+                refs.append(burst_scenes[ref])
+                secs.append(burst_scenes[sec])
+    return refs, secs
+
+
+@contextmanager
+def _timer(timings, stage):
+    start = time.perf_counter()
+    yield
+    timings[stage] = time.perf_counter() - start
+
+
+def run_pipeline(aoi_id, fixtures, project_name = 'simulation', aoi_file = None, num = 1, seed = 0, hyp3 = None):
+    """
+    Runs the pipeline from the area of interest to the submitted jobs with local stand-ins and times each stage.
+
+    The S1 burst catalog is read from the local copy (see aoi.update_s1_catalog), so the pipeline runs offline
+    once the catalog has been downloaded.
+
+    Args:
+        aoi_id: Id for the area of interest.
+        fixtures: Fixtures with the recorded search results and coherence.
+        project_name: Name of the project for the jobs.
+        aoi_file: Path to the parquet file with the areas of interest. If None it takes the parquet file in cache.
+        num: Number of burst(s) to estimate the mean coherence.
+        seed: Seed for the random choices, so runs can be reproduced.
+        hyp3: Stand-in for HyP3. If None a FixtureHyP3 is used.
+
+    Returns:
+        outputs: Dictionary with the output of each stage.
+        timings: Dictionary with the time in seconds of each stage.
+    """
+    random.seed(seed)
+    hyp3 = FixtureHyP3() if hyp3 is None else hyp3
+    outputs = dict()
+    timings = dict()
+    with _timer(timings, 'get_burst_ids'):
+        outputs['burst_ids'] = aoi.get_burst_ids(aoi_id, aoi_file=aoi_file, search=fixtures.search, cache_file=None)
+    with _timer(timings, 'get_multibursts'):
+        outputs['multibursts'] = pm.get_multibursts(list(outputs['burst_ids'].keys()), multiburst_class=FixtureMultiBurst, use_cache=False)
+    with _timer(timings, 'get_coherence'):
+        outputs['coherence'] = [pairs.get_coherence(multiburst.multiburst_dict, num=num, search=fixtures.search, pair_class=fixtures.pair)
+                                for multiburst in outputs['multibursts']]
+    with _timer(timings, 'get_pairs'):
+        outputs['pairs'] = [get_sequential_pairs(multiburst, fixtures.search) for multiburst in outputs['multibursts']]
+    with _timer(timings, 'prepare_multiburst_jobs'):
+        outputs['insar_jobs'] = []
+        for refs, secs in outputs['pairs']:
+            if len(refs) > 0:
+                outputs['insar_jobs'] += pairs.prepare_multiburst_jobs(refs, secs, project_name, hyp3)
+    with _timer(timings, 'submit_jobs'):
+        outputs['jobs'] = pairs.submit_jobs(outputs['insar_jobs'], hyp3)
+    return outputs, timings
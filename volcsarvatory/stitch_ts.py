@@ -1,34 +1,72 @@
 import h5py
 import numpy as np
 import matplotlib.pyplot as plt
-import shutil
+import os
+import warnings
 import xarray as xr
 
-from scipy.interpolate import RegularGridInterpolator
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
 
+EPOCH_DATASETS = ('date', 'timeseries', 'bperp')
 
-def change_reference(h5file, ref_coords):
+
+def _get_tiles(dset, max_memory_mb):
+    """Splits the spatial extent of a timeseries dataset into tiles.
+
+    Args:
+        dset: H5 dataset with dimensions (time, rows, columns).
+        max_memory_mb: Maximum size in MB of a tile holding all the epochs.
+
+    Returns:
+        tiles: List of (row slice, column slice) tuples. Tiles are aligned with the dataset chunks.
+    """
+    ntimes, length, width = dset.shape
+    chunk_rows, chunk_cols = dset.chunks[1:] if dset.chunks is not None else (1, 1)
+    pixels = max(1, int(max_memory_mb * 1024**2 / (ntimes * dset.dtype.itemsize)))
+    if pixels >= width:
+        rows = max(chunk_rows, (pixels // width) // chunk_rows * chunk_rows)
+        cols = width
+    else:
+        rows = chunk_rows
+        cols = min(width, max(chunk_cols, (pixels // chunk_rows) // chunk_cols * chunk_cols))
+    tiles = []
+    for row in range(0, length, rows):
+        for col in range(0, width, cols):
+            tiles.append((slice(row, min(row + rows, length)), slice(col, min(col + cols, width))))
+    return tiles
+
+
+def change_reference(h5file, ref_coords, max_memory_mb=512):
     """Changes the reference pixel on the timeseries.
 
+    The timeseries is rewritten in place tile by tile, so the memory used is bounded by max_memory_mb
+    and not by the size of the stack.
+
     Args:
         h5file: H5 file with the timeseries.
         ref_coords: reference pixel in lon/lat coordinates.
+        max_memory_mb: Maximum memory in MB used to hold a tile of the timeseries.
     """
     h5f = h5py.File(h5file,'r+')
     dates = [date.decode('utf-8') for date in h5f['date'][:]]
-    timeseries = h5f['timeseries'][:]
+    dset = h5f['timeseries']
     ul = (float(h5f.attrs['X_FIRST']), float(h5f.attrs['Y_FIRST']))
     steps = (float(h5f.attrs['X_STEP']), float(h5f.attrs['Y_STEP']))
-    lons = np.linspace(ul[0], ul[0]+steps[0]*timeseries.shape[2], timeseries.shape[2])
-    lats = np.linspace(ul[1]+steps[1]*timeseries.shape[1], ul[1], timeseries.shape[1])[::-1]
+    lons = np.linspace(ul[0], ul[0]+steps[0]*dset.shape[2], dset.shape[2])
+    lats = np.linspace(ul[1]+steps[1]*dset.shape[1], ul[1], dset.shape[1])[::-1]
     j=np.argmin(np.abs(lons-ref_coords[0]))
     i=np.argmin(np.abs(lats-ref_coords[1]))
-    timeseries[timeseries==0]=np.nan
-    for t in range(timeseries.shape[0]):
-        timeseries[t,:,:] -= timeseries[t,i,j]
-    timeseries[np.isnan(timeseries)]=0
-    timeseries -= timeseries[0,:,:]
-    h5f['timeseries'][:] = timeseries
+    ref_values = dset[:,i,j]
+    ref_values[ref_values==0]=np.nan
+    for rows, cols in _get_tiles(dset, max_memory_mb):
+        tile = dset[:,rows,cols]
+        tile[tile==0]=np.nan
+        tile -= ref_values[:,None,None]
+        tile[np.isnan(tile)]=0
+        tile -= tile[0,:,:]
+        dset[:,rows,cols] = tile
     h5f.attrs['REF_DATE'] = dates[0]
     h5f.attrs['REF_LAT'] = lats[i]
     h5f.attrs['REF_LON'] = lons[j]
@@ -37,67 +75,612 @@ def change_reference(h5file, ref_coords):
     h5f.close()
 
 
-def merge_timeseries(reference, h5file):
+def _get_grid(h5f):
+    """Reads the geographic grid of a timeseries file.
+
+    Args:
+        h5f: Open H5 file with the timeseries.
+
+    Returns:
+        grid: Tuple with (X_FIRST, Y_FIRST, X_STEP, Y_STEP, length, width).
+    """
+    _, length, width = h5f['timeseries'].shape
+    return (float(h5f.attrs['X_FIRST']), float(h5f.attrs['Y_FIRST']),
+            float(h5f.attrs['X_STEP']), float(h5f.attrs['Y_STEP']), length, width)
+
+
+def _nearest_index(first, step, size, first_src, step_src, size_src):
+    """Maps the pixels of a grid axis to the nearest pixels of another grid axis.
+
+    Args:
+        first: Coordinate of the first pixel edge in the output axis.
+        step: Pixel size in the output axis.
+        size: Number of pixels in the output axis.
+        first_src: Coordinate of the first pixel edge in the source axis.
+        step_src: Pixel size in the source axis.
+        size_src: Number of pixels in the source axis.
+
+    Returns:
+        index: Integer array with the source pixel for each output pixel, -1 where it falls outside the source.
+    """
+    centers = first + (np.arange(size) + 0.5) * step
+    index = np.floor((centers - first_src) / step_src).astype(np.int64)
+    index[(index < 0) | (index >= size_src)] = -1
+    return index
+
+
+def _get_index_map(grid, grid_src):
+    """Computes the nearest neighbour mapping from a source grid to an output grid.
+
+    Args:
+        grid: Output grid as returned by _get_grid.
+        grid_src: Source grid as returned by _get_grid.
+
+    Returns:
+        rows: Source row for each output row, -1 outside the source.
+        cols: Source column for each output column, -1 outside the source.
+    """
+    cols = _nearest_index(grid[0], grid[2], grid[5], grid_src[0], grid_src[2], grid_src[5])
+    rows = _nearest_index(grid[1], grid[3], grid[4], grid_src[1], grid_src[3], grid_src[4])
+    return rows, cols
+
+
+def _resample(block, rows, cols):
+    """Resamples a block of epochs with a nearest neighbour index map.
+
+    Args:
+        block: Array with dimensions (time, rows, columns) in the source grid.
+        rows: Source row for each output row, -1 outside the source.
+        cols: Source column for each output column, -1 outside the source.
+
+    Returns:
+        resampled: Array with dimensions (time, rows, columns) in the output grid, 0 outside the source.
+    """
+    resampled = block[:, np.maximum(rows, 0)[:, None], np.maximum(cols, 0)[None, :]]
+    resampled[:, rows < 0, :] = 0
+    resampled[:, :, cols < 0] = 0
+    return resampled
+
+
+def _resample_rows(dset, start, rows, cols):
+    """Reads and resamples a band of rows of a timeseries dataset from an epoch to the last one.
+
+    Args:
+        dset: Source timeseries dataset.
+        start: First epoch.
+        rows: Source row for each output row of the band, -1 outside the source.
+        cols: Source column for each output column, -1 outside the source.
+
+    Returns:
+        resampled: Array with dimensions (time, rows, columns) in the output grid, 0 outside the source.
+    """
+    valid = rows[rows >= 0]
+    if len(valid) == 0:
+        return np.zeros((dset.shape[0] - start, len(rows), len(cols)))
+    block = dset[start:, valid.min():valid.max()+1, :].astype(np.float64)
+    return _resample(block, np.where(rows >= 0, rows - valid.min(), -1), cols)
+
+
+def _set_reference(block, ref_pix):
+    """Subtracts the value of the reference pixel to each epoch, ignoring no data values.
+
+    Args:
+        block: Array with dimensions (time, rows, columns) where 0 is no data.
+        ref_pix: Reference pixel as (row, column).
+
+    Returns:
+        block: Referenced array where 0 is no data.
+    """
+    block[block==0] = np.nan
+    block -= block[:, ref_pix[0], ref_pix[1]][:, None, None]
+    block[np.isnan(block)] = 0
+    return block
+
+
+def _get_layout(shape, dtype=np.float32, chunks=None, compression=None):
+    """Gets the arguments of h5py create_dataset for the layout of a timeseries dataset.
+
+    Args:
+        shape: Shape of the timeseries (time, rows, columns).
+        dtype: Data type of the timeseries.
+        chunks: Chunk shape (time, rows, columns), where None takes the whole dimension (e.g. (None, 64, 64)
+                for the whole time series of 64x64 tiles). If None h5py picks the chunk shape.
+        compression: None, 'lzf', 'gzip' or 'blosc'. Blosc needs hdf5plugin, also to read the file,
+                     and falls back to lzf if it is not installed.
+
+    Returns:
+        layout: Dictionary with the arguments for create_dataset. The time dimension can be resized.
+    """
+    layout = {'dtype': dtype, 'maxshape': (None,)+tuple(shape[1:]), 'chunks': True}
+    if chunks is not None:
+        layout['chunks'] = tuple(max(1, min(size if chunk is None else chunk, size)) for chunk, size in zip(chunks, shape))
+    if compression == 'blosc':
+        try:
+            import hdf5plugin
+            layout.update(hdf5plugin.Blosc(cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+        except ImportError:
+            warnings.warn('hdf5plugin is not installed, lzf compression is used instead of blosc.', UserWarning)
+            layout['compression'] = 'lzf'
+    elif compression == 'gzip':
+        layout.update({'compression': 'gzip', 'compression_opts': 4})
+    elif compression is not None:
+        layout['compression'] = compression
+    return layout
+
+
+def _get_band_rows(dset, num_dates, width, itemsize, max_memory_mb):
+    """Gets the number of rows of the bands written with all their epochs, aligned to the chunks of a dataset.
+
+    Args:
+        dset: Output dataset.
+        num_dates: Number of epochs of a band.
+        width: Number of columns of a band.
+        itemsize: Size in bytes of the values held in memory.
+        max_memory_mb: Maximum memory in MB used to hold a band.
+
+    Returns:
+        band_rows: Number of rows of each band.
+    """
+    chunk_rows = dset.chunks[1] if dset.chunks is not None else 1
+    band_rows = int(max_memory_mb * 1024**2 / (2 * itemsize * max(num_dates, 1) * width))
+    return max(chunk_rows, band_rows // chunk_rows * chunk_rows)
+
+
+def merge_timeseries(reference, h5file, out_file='newtimeseries.h5', max_memory_mb=512, dtype=np.float32,
+                     chunks=None, compression=None):
     """Merges two timeseries.
 
+    The second timeseries is resampled to the grid of the first one with a nearest neighbour index map
+    computed once, and the merged timeseries is written by bands of rows with all their epochs, aligned
+    to the output chunks and bounded by max_memory_mb, so each chunk is written once.
+    The epoch datasets of the output can be resized, so later epochs can be added with append_timeseries.
+
     Args:
         reference: H5 file with the first timeseries.
         h5file: H5 file with the second timeseries.
+        out_file: H5 file where the merged timeseries is written.
+        max_memory_mb: Maximum memory in MB used to hold a band of rows.
+        dtype: Data type of the merged timeseries.
+        chunks: Chunk shape (time, rows, columns) of the merged timeseries, see _get_layout.
+        compression: None, 'lzf', 'gzip' or 'blosc', see _get_layout.
     """
     h5f = h5py.File(reference)
+    h5f_sec = h5py.File(h5file)
     dates1 = [date.decode('utf-8') for date in h5f['date'][:]]
-    timeseries1 = h5f['timeseries'][:]
-    ref_pix = (h5f.attrs['REF_Y'], h5f.attrs['REF_X'])
-    ref_coord = (h5f.attrs['REF_LON'], h5f.attrs['REF_LAT'])
-    ul = (float(h5f.attrs['X_FIRST']), float(h5f.attrs['Y_FIRST']))
-    steps = (float(h5f.attrs['X_STEP']), float(h5f.attrs['Y_STEP']))
-    lons = np.linspace(ul[0], ul[0]+steps[0]*timeseries1.shape[2], timeseries1.shape[2])
-    lats = np.linspace(ul[1]+steps[1]*timeseries1.shape[1], ul[1], timeseries1.shape[1])
-    LONS,LATS=np.meshgrid(lons,lats)
-    shape = (timeseries1.shape[1], timeseries1.shape[2])
-    h5f.close()
+    dates2 = [date.decode('utf-8') for date in h5f_sec['date'][:]]
+    ref_pix = (int(h5f.attrs['REF_Y']), int(h5f.attrs['REF_X']))
+    grid = _get_grid(h5f)
+    rows, cols = _get_index_map(grid, _get_grid(h5f_sec))
+    shape = (grid[4], grid[5])
 
-    h5f = h5py.File(h5file)
-    dates2 = [date.decode('utf-8') for date in h5f['date'][:]]
-    timeseries = h5f['timeseries'][:]
-    ul_sec = (float(h5f.attrs['X_FIRST']), float(h5f.attrs['Y_FIRST']))
-    steps_sec = (float(h5f.attrs['X_STEP']), float(h5f.attrs['Y_STEP']))
-    lons_sec = np.linspace(ul_sec[0], ul_sec[0]+steps_sec[0]*timeseries.shape[2], timeseries.shape[2])
-    lats_sec = np.linspace(ul_sec[1]+steps_sec[1]*timeseries.shape[1], ul_sec[1], timeseries.shape[1])
-    shape_sec = (timeseries.shape[1], timeseries.shape[2])
-    h5f.close()
-    
-    
-    newdates = list(dates1)+sorted(list((set(dates2)-set(dates1))))
-    intdates = set(dates1).intersection(set(dates2))
-    index1 = dates1.index(sorted(intdates)[int(len(intdates)/2)])
-    index2 = dates2.index(sorted(intdates)[int(len(intdates)/2)])
-    index3 = dates2.index(sorted(intdates)[-1])
+    intdates = sorted(set(dates1).intersection(set(dates2)))
+    index1 = dates1.index(intdates[int(len(intdates)/2)])
+    index2 = dates2.index(intdates[int(len(intdates)/2)])
+    index3 = dates2.index(intdates[-1])
+    newdates = dates1 + dates2[index3+1:]
     print(index1,index2)
-    newtimeseries = np.ones((timeseries.shape[0],timeseries1.shape[1], timeseries1.shape[2]))*np.nan
-    for i in range(timeseries.shape[0]):
-        interp_sec = RegularGridInterpolator((lats_sec,lons_sec), timeseries[i,:,:], method='nearest', bounds_error=False, fill_value=0.0)
-        newtimeslice = interp_sec(np.c_[LATS.ravel(),LONS.ravel()])
-        newtimeslice = newtimeslice.reshape((LONS.shape[0], LONS.shape[1]))
-        newtimeslice[newtimeslice==0] = np.nan
-        newtimeslice -= newtimeslice[int(ref_pix[0]),int(ref_pix[1])]
-        newtimeslice[np.isnan(newtimeslice)] = 0
-        newtimeseries[i,:,:] = newtimeslice
-
-    timeseries1 -= timeseries1[index1,:,:]
-    newtimeseries -= newtimeseries[index2,:,:]
-    timeseries_all = np.ones((len(newdates),timeseries1.shape[1], timeseries1.shape[2]))
-    timeseries_all[0:timeseries1.shape[0],:,:] = timeseries1
-    timeseries_all[timeseries1.shape[0]:,:,:] = newtimeseries[index3+1:,:,:]
-    timeseries_all -= timeseries_all[0,:,:]
-    
-    shutil.copy(reference,'newtimeseries.h5')
-    h5f = h5py.File('newtimeseries.h5','r+')
-    del h5f['date']
-    h5f.create_dataset('date', data=np.array(newdates, dtype="S8"))
-    h5f.attrs['REF_DATE'] = dates1[0]
-    h5f.attrs['END_DATE'] = dates2[-1]
-    del h5f['timeseries']
-    h5f.create_dataset('timeseries', data=timeseries_all)
+
+    timeseries1 = h5f['timeseries']
+    timeseries2 = h5f_sec['timeseries']
+    first = timeseries1[0,:,:].astype(np.float64)
+    offset = first - timeseries1[index1,:,:]
+    offset += _set_reference(_resample(timeseries2[index2:index2+1,:,:], rows, cols), ref_pix)[0]
+
+    h5f_out = h5py.File(out_file,'w')
+    h5f_out.attrs.update(h5f.attrs)
+    for name in h5f.keys():
+        if name not in EPOCH_DATASETS:
+            h5f.copy(h5f[name], h5f_out, name=name)
+    h5f_out.create_dataset('date', data=np.array(newdates, dtype="S8"), maxshape=(None,))
+    if 'bperp' in h5f.keys():
+        bperp2 = h5f_sec['bperp'][index3+1:] if 'bperp' in h5f_sec.keys() else np.zeros(len(dates2)-index3-1)
+        h5f_out.create_dataset('bperp', data=np.concatenate([h5f['bperp'][:], bperp2]), maxshape=(None,))
+    h5f_out.attrs['REF_DATE'] = dates1[0]
+    h5f_out.attrs['END_DATE'] = dates2[-1]
+    timeseries_all = h5f_out.create_dataset('timeseries', shape=(len(newdates),)+shape,
+                                            **_get_layout((len(newdates),)+shape, dtype, chunks, compression))
+
+    num1 = len(dates1)
+    num2 = len(dates2) - index3 - 1
+    ref_row, ref_col = rows[ref_pix[0]], cols[ref_pix[1]]
+    if ref_row < 0 or ref_col < 0:
+        ref_values = np.full(num2, np.nan)
+    else:
+        ref_values = timeseries2[index3+1:, ref_row, ref_col].astype(np.float64)
+        ref_values[ref_values == 0] = np.nan
+
+    band_rows = _get_band_rows(timeseries_all, num1 + num2, shape[1], 8, max_memory_mb)
+    for row0 in range(0, shape[0], band_rows):
+        row1 = min(row0 + band_rows, shape[0])
+        band = np.empty((num1 + num2, row1 - row0, shape[1]))
+        band[:num1] = timeseries1[:, row0:row1, :] - first[row0:row1]
+        if num2 > 0:
+            block = _resample_rows(timeseries2, index3+1, rows[row0:row1], cols)
+            block[block == 0] = np.nan
+            block -= ref_values[:, None, None]
+            block[np.isnan(block)] = 0
+            band[num1:] = block - offset[row0:row1]
+        timeseries_all[:, row0:row1, :] = band
+    h5f_out.close()
+    h5f_sec.close()
     h5f.close()
 
+
+def rechunk_timeseries(h5file, out_file=None, dtype=np.float32, chunks=(None, 64, 64), compression='lzf', max_memory_mb=512):
+    """Rewrites a timeseries file with another layout of the timeseries dataset.
+
+    The timeseries is copied by bands of rows with all their epochs, aligned to the output chunks, so
+    each chunk is written once. The epoch datasets (timeseries, date and bperp) of the output can be resized.
+    The default layout (float32 with the whole time series of 64x64 tiles per chunk) makes reading the
+    time series of a pixel or a tile read a single chunk.
+
+    Args:
+        h5file: H5 file with the timeseries.
+        out_file: H5 file where the timeseries is written. If None the input file is replaced.
+        dtype: Data type of the timeseries. If None it keeps the data type of the input.
+        chunks: Chunk shape (time, rows, columns), see _get_layout.
+        compression: None, 'lzf', 'gzip' or 'blosc', see _get_layout.
+        max_memory_mb: Maximum memory in MB used to hold a band of rows.
+    """
+    h5file = Path(h5file)
+    temp = h5file.with_name(f'.{h5file.name}.tmp') if out_file is None else Path(out_file)
+    with h5py.File(h5file) as h5f, h5py.File(temp, 'w') as h5f_out:
+        h5f_out.attrs.update(h5f.attrs)
+        for name in h5f.keys():
+            if name not in EPOCH_DATASETS:
+                h5f.copy(h5f[name], h5f_out, name=name)
+        for name in ('date', 'bperp'):
+            if name in h5f.keys():
+                h5f_out.create_dataset(name, data=h5f[name][:], maxshape=(None,))
+        timeseries = h5f['timeseries']
+        dtype = timeseries.dtype if dtype is None else dtype
+        timeseries_out = h5f_out.create_dataset('timeseries', shape=timeseries.shape,
+                                                **_get_layout(timeseries.shape, dtype, chunks, compression))
+        band_rows = _get_band_rows(timeseries_out, timeseries.shape[0], timeseries.shape[2], timeseries.dtype.itemsize, max_memory_mb)
+        for row0 in range(0, timeseries.shape[1], band_rows):
+            timeseries_out[:, row0:row0+band_rows, :] = timeseries[:, row0:row0+band_rows, :]
+    if out_file is None:
+        os.replace(temp, h5file)
+
+
+def make_appendable(h5file, max_memory_mb=512):
+    """Rewrites a timeseries file so its epoch datasets (timeseries, date and bperp) can be resized.
+
+    It is only needed once for files that were not written by merge_timeseries or rechunk_timeseries,
+    before append_timeseries.
+
+    Args:
+        h5file: H5 file with the timeseries.
+        max_memory_mb: Maximum memory in MB used to hold a band of rows.
+    """
+    rechunk_timeseries(h5file, dtype=None, chunks=None, compression=None, max_memory_mb=max_memory_mb)
+
+
+def append_timeseries(reference, h5file, max_memory_mb=512):
+    """Appends the epochs of a timeseries that are later than the last epoch of another one, in place.
+
+    The new epochs are resampled to the grid of the reference file, referenced to its reference pixel and
+    aligned to it with the offset at a date both timeseries share (as in merge_timeseries). Only the
+    new epochs are written, so the cost is proportional to the new data. The epoch datasets of the
+    reference file must be resizable (see merge_timeseries and make_appendable).
+
+    Args:
+        reference: H5 file with the timeseries that is extended.
+        h5file: H5 file with the timeseries that has the new epochs.
+        max_memory_mb: Maximum memory in MB used to hold a block of epochs.
+
+    Returns:
+        newdates: List with the dates appended.
+    """
+    with h5py.File(reference, 'r+') as h5f, h5py.File(h5file) as h5f_new:
+        timeseries = h5f['timeseries']
+        epoch_datasets = [name for name in EPOCH_DATASETS if name in h5f.keys()]
+        if any(h5f[name].maxshape[0] is not None for name in epoch_datasets):
+            raise ValueError(f'The epoch datasets of {reference} cannot be resized. Run make_appendable first.')
+        dates1 = [date.decode('utf-8') for date in h5f['date'][:]]
+        dates2 = [date.decode('utf-8') for date in h5f_new['date'][:]]
+        newdates = [date for date in dates2 if date > dates1[-1]]
+        if len(newdates) == 0:
+            return newdates
+        intdates = sorted(set(dates1).intersection(set(dates2)))
+        if len(intdates) == 0:
+            raise ValueError(f'{reference} and {h5file} do not share any date to align them.')
+
+        ref_pix = (int(h5f.attrs['REF_Y']), int(h5f.attrs['REF_X']))
+        grid = _get_grid(h5f)
+        rows, cols = _get_index_map(grid, _get_grid(h5f_new))
+        index1 = dates1.index(intdates[int(len(intdates)/2)])
+        index2 = dates2.index(intdates[int(len(intdates)/2)])
+        timeseries2 = h5f_new['timeseries']
+        offset = _set_reference(_resample(timeseries2[index2:index2+1,:,:].astype(np.float64), rows, cols), ref_pix)[0]
+        offset -= timeseries[index1,:,:]
+
+        start = len(dates1)
+        first_new = dates2.index(newdates[0])
+        for name in epoch_datasets:
+            h5f[name].resize(start + len(newdates), axis=0)
+        h5f['date'][start:] = np.array(newdates, dtype="S8")
+        if 'bperp' in epoch_datasets:
+            h5f['bperp'][start:] = h5f_new['bperp'][first_new:] if 'bperp' in h5f_new.keys() else 0
+
+        step = max(1, int(max_memory_mb * 1024**2 / (2 * 8 * grid[4] * grid[5])))
+        for t in range(first_new, len(dates2), step):
+            end = min(t + step, len(dates2))
+            block = _set_reference(_resample(timeseries2[t:end,:,:].astype(np.float64), rows, cols), ref_pix)
+            timeseries[start+t-first_new:start+end-first_new,:,:] = block - offset
+        h5f.attrs['END_DATE'] = newdates[-1]
+    return newdates
+
+
+def _get_union_grid(grids):
+    """Computes a grid covering several grids, aligned with the pixels of the first one.
+
+    Args:
+        grids: List of grids as returned by _get_grid.
+
+    Returns:
+        grid: Union grid as (X_FIRST, Y_FIRST, X_STEP, Y_STEP, length, width).
+    """
+    x_first, y_first, x_step, y_step = grids[0][0:4]
+    xmin = min(grid[0] for grid in grids)
+    xmax = max(grid[0] + grid[2]*grid[5] for grid in grids)
+    ymax = max(grid[1] for grid in grids)
+    ymin = min(grid[1] + grid[3]*grid[4] for grid in grids)
+    # round before floor/ceil so that floating point noise doesn't add a pixel
+    x_first += np.floor(np.round((xmin - x_first) / x_step, 6)) * x_step
+    y_first += np.floor(np.round((ymax - y_first) / y_step, 6)) * y_step
+    width = int(np.ceil(np.round((xmax - x_first) / x_step, 6)))
+    length = int(np.ceil(np.round((ymin - y_first) / y_step, 6)))
+    return (x_first, y_first, x_step, y_step, length, width)
+
+
+def _get_window(rows, cols):
+    """Finds the window of the output grid covered by a source grid.
+
+    Args:
+        rows: Source row for each output row, -1 outside the source.
+        cols: Source column for each output column, -1 outside the source.
+
+    Returns:
+        window: Tuple with (first row, last row + 1, first column, last column + 1) in the output grid.
+    """
+    valid_rows = np.flatnonzero(rows >= 0)
+    valid_cols = np.flatnonzero(cols >= 0)
+    return (valid_rows[0], valid_rows[-1] + 1, valid_cols[0], valid_cols[-1] + 1)
+
+
+def _get_subgrid(grid, window):
+    """Gets the grid of a window of a grid.
+
+    Args:
+        grid: Grid as returned by _get_grid.
+        window: Tuple with (first row, last row + 1, first column, last column + 1).
+
+    Returns:
+        subgrid: Grid of the window.
+    """
+    return (grid[0] + window[2]*grid[2], grid[1] + window[0]*grid[3], grid[2], grid[3],
+            window[1] - window[0], window[3] - window[2])
+
+
+def _read_window(dset, epochs, rows, cols):
+    """Reads the epochs of a timeseries dataset resampled to a window of the output grid.
+
+    Only the source pixels needed by the window are read from the file.
+
+    Args:
+        dset: H5 timeseries dataset in the source grid.
+        epochs: Increasing list of epoch indices to read.
+        rows: Source row for each row of the window, -1 outside the source.
+        cols: Source column for each column of the window, -1 outside the source.
+
+    Returns:
+        resampled: Array with dimensions (epochs, rows, columns) in the window, 0 outside the source.
+    """
+    row0, row1 = rows[rows >= 0].min(), rows.max() + 1
+    col0, col1 = cols[cols >= 0].min(), cols.max() + 1
+    block = dset[epochs, row0:row1, col0:col1]
+    return _resample(block, np.where(rows >= 0, rows - row0, -1), np.where(cols >= 0, cols - col0, -1))
+
+
+def _estimate_tie_points(args):
+    """Estimates the offsets between two timeseries in their overlap.
+
+    Args:
+        args: Tuple with the two H5 files, the output grid, the overlap window and the memory limit in MB.
+
+    Returns:
+        tie_points: Dictionary where the keys are the common dates and the elements are the median
+                    difference between the first and the second timeseries in the overlap.
+    """
+    h5file1, h5file2, grid, window, max_memory_mb = args
+    subgrid = _get_subgrid(grid, window)
+    h5f1 = h5py.File(h5file1)
+    h5f2 = h5py.File(h5file2)
+    dates1 = [date.decode('utf-8') for date in h5f1['date'][:]]
+    dates2 = [date.decode('utf-8') for date in h5f2['date'][:]]
+    rows1, cols1 = _get_index_map(subgrid, _get_grid(h5f1))
+    rows2, cols2 = _get_index_map(subgrid, _get_grid(h5f2))
+    intdates = sorted(set(dates1).intersection(set(dates2)))
+    step = max(1, int(max_memory_mb * 1024**2 / (4 * 8 * subgrid[4] * subgrid[5])))
+    tie_points = dict()
+    for i in range(0, len(intdates), step):
+        dates = intdates[i:i+step]
+        block1 = _read_window(h5f1['timeseries'], [dates1.index(date) for date in dates], rows1, cols1)
+        block2 = _read_window(h5f2['timeseries'], [dates2.index(date) for date in dates], rows2, cols2)
+        diff = np.where((block1 != 0) & (block2 != 0), block1.astype(np.float64) - block2, np.nan)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            medians = np.nanmedian(diff, axis=(1, 2))
+        for date, median in zip(dates, medians):
+            if not np.isnan(median):
+                tie_points[date] = median
+    h5f2.close()
+    h5f1.close()
+    return tie_points
+
+
+def _nearest_value(values, date):
+    """Gets the value for a date or, if it is missing, for the closest date.
+
+    Args:
+        values: Dictionary where the keys are dates in YYYYMMDD format.
+        date: Date in YYYYMMDD format.
+
+    Returns:
+        value: Value for the closest date.
+    """
+    if date in values.keys():
+        return values[date]
+    day = datetime.strptime(date, '%Y%m%d')
+    closest = min(values.keys(), key=lambda key: abs((datetime.strptime(key, '%Y%m%d') - day).days))
+    return values[closest]
+
+
+def _solve_offsets(dates, tie_points):
+    """Chains the tie points between overlapping timeseries into an offset per date for each timeseries.
+
+    For each date the offsets are propagated from the first timeseries through the overlaps with a tie point
+    on that date. Timeseries that can't be reached on a date take their offset from the closest date.
+
+    Args:
+        dates: List with the dates of each timeseries.
+        tie_points: Dictionary where the keys are pairs of timeseries indices (i, j) with i < j and the elements
+                    are dictionaries with the median difference between the timeseries i and j per date.
+
+    Returns:
+        offsets: List of dictionaries with the offset of each date of each timeseries.
+    """
+    offsets = [dict() for _ in dates]
+    newdates = sorted(set().union(*dates))
+    # the second pass fills the dates before the first date that could be solved
+    for _ in range(2):
+        for date in newdates:
+            inputs = [i for i in range(len(dates)) if date in dates[i]]
+            if 0 in inputs:
+                offsets[0][date] = 0.0
+            while True:
+                queue = [i for i in inputs if date in offsets[i].keys()]
+                while queue:
+                    i = queue.pop(0)
+                    for j in inputs:
+                        edge = tie_points.get((min(i, j), max(i, j)), dict())
+                        if date in offsets[j].keys() or date not in edge.keys():
+                            continue
+                        sign = 1 if i < j else -1
+                        offsets[j][date] = offsets[i][date] + sign*edge[date]
+                        queue.append(j)
+                missing = [i for i in inputs if date not in offsets[i].keys() and len(offsets[i]) > 0]
+                if len(missing) == 0:
+                    break
+                offsets[missing[0]][date] = _nearest_value(offsets[missing[0]], date)
+    return offsets
+
+
+def mosaic_timeseries(h5files, out_file='mosaic_timeseries.h5', num_workers=None, max_memory_mb=512, dtype=np.float32,
+                      chunks=None, compression=None):
+    """Mosaics several overlapping timeseries into a shared output grid.
+
+    The output grid covers all the inputs with the pixel spacing of the first one, and the output dates are
+    the union of the dates of the inputs. The offsets of each input are estimated per date from the median
+    difference with the overlapping inputs (tie points), chaining them from the first input. The tie points
+    are estimated in parallel, and the mosaic is written by bands of rows with all their epochs, aligned
+    to the output chunks. Inputs should share the reference date. Where inputs overlap, the first input in
+    the list is kept, and the perpendicular baseline of each date is taken from the first input with that date.
+    The other datasets are copied from the first input and the epoch datasets can be resized, so later
+    epochs can be added with append_timeseries.
+
+    Args:
+        h5files: List of H5 files with the timeseries. The first one sets the reference and pixel spacing.
+        out_file: H5 file where the mosaicked timeseries is written.
+        num_workers: Number of processes used to estimate the tie points. If None it uses the number of CPUs.
+        max_memory_mb: Maximum memory in MB used to hold a block of epochs or a band of rows.
+        dtype: Data type of the mosaicked timeseries.
+        chunks: Chunk shape (time, rows, columns) of the mosaicked timeseries, see _get_layout.
+        compression: None, 'lzf', 'gzip' or 'blosc', see _get_layout.
+
+    Returns:
+        offsets: List of dictionaries with the offset applied to each date of each input.
+    """
+    grids = []
+    dates = []
+    bperps = []
+    for h5file in h5files:
+        h5f = h5py.File(h5file)
+        grids.append(_get_grid(h5f))
+        dates.append([date.decode('utf-8') for date in h5f['date'][:]])
+        bperps.append(h5f['bperp'][:] if 'bperp' in h5f.keys() else np.zeros(len(dates[-1])))
+        if h5file == h5files[0]:
+            attrs = dict(h5f.attrs)
+        h5f.close()
+    grid = _get_union_grid(grids)
+    newdates = sorted(set().union(*dates))
+    index_maps = [_get_index_map(grid, grid_src) for grid_src in grids]
+    windows = [_get_window(rows, cols) for rows, cols in index_maps]
+
+    jobs = dict()
+    for i in range(len(h5files)):
+        for j in range(i+1, len(h5files)):
+            window = (max(windows[i][0], windows[j][0]), min(windows[i][1], windows[j][1]),
+                      max(windows[i][2], windows[j][2]), min(windows[i][3], windows[j][3]))
+            if window[0] < window[1] and window[2] < window[3]:
+                jobs[(i, j)] = (h5files[i], h5files[j], grid, window, max_memory_mb)
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        tie_points = dict(zip(jobs.keys(), executor.map(_estimate_tie_points, jobs.values())))
+
+    offsets = _solve_offsets(dates, tie_points)
+    for i, offset in enumerate(offsets):
+        if len(offset) < len(dates[i]):
+            warnings.warn(f'{h5files[i]} does not overlap with the other timeseries. No offset applied.', UserWarning)
+            offsets[i] = {date: offset.get(date, 0.0) for date in dates[i]}
+
+    bperp = np.zeros(len(newdates))
+    for t, date in enumerate(newdates):
+        i = next(i for i in range(len(h5files)) if date in offsets[i].keys())
+        bperp[t] = bperps[i][dates[i].index(date)]
+
+    h5f_out = h5py.File(out_file,'w')
+    h5f_out.attrs.update(attrs)
+    h5f_out.attrs['X_FIRST'] = str(grid[0])
+    h5f_out.attrs['Y_FIRST'] = str(grid[1])
+    h5f_out.attrs['LENGTH'] = str(grid[4])
+    h5f_out.attrs['WIDTH'] = str(grid[5])
+    if 'REF_Y' in attrs.keys() and 'REF_X' in attrs.keys():
+        h5f_out.attrs['REF_Y'] = int(np.flatnonzero(index_maps[0][0] == int(attrs['REF_Y']))[0])
+        h5f_out.attrs['REF_X'] = int(np.flatnonzero(index_maps[0][1] == int(attrs['REF_X']))[0])
+    h5f_out.attrs['START_DATE'] = newdates[0]
+    h5f_out.attrs['END_DATE'] = newdates[-1]
+    with h5py.File(h5files[0]) as h5f:
+        for name in h5f.keys():
+            if name not in EPOCH_DATASETS:
+                h5f.copy(h5f[name], h5f_out, name=name)
+    h5f_out.create_dataset('date', data=np.array(newdates, dtype="S8"), maxshape=(None,))
+    h5f_out.create_dataset('bperp', data=bperp.astype(np.float32), maxshape=(None,))
+    shape = (len(newdates), grid[4], grid[5])
+    timeseries = h5f_out.create_dataset('timeseries', shape=shape, **_get_layout(shape, dtype, chunks, compression))
+
+    h5fs = [h5py.File(h5file) for h5file in h5files]
+    band_rows = _get_band_rows(timeseries, len(newdates), grid[5], 8, max_memory_mb)
+    for row0 in range(0, grid[4], band_rows):
+        row1 = min(row0 + band_rows, grid[4])
+        band = np.zeros((len(newdates), row1 - row0, grid[5]))
+        for i, h5f in enumerate(h5fs):
+            first_row, last_row = max(windows[i][0], row0), min(windows[i][1], row1)
+            if first_row >= last_row:
+                continue
+            col0, col1 = windows[i][2:4]
+            rows, cols = index_maps[i]
+            epochs = sorted(dates[i].index(date) for date in offsets[i].keys())
+            out_epochs = [newdates.index(dates[i][epoch]) for epoch in epochs]
+            block = _read_window(h5f['timeseries'], epochs, rows[first_row:last_row], cols[col0:col1])
+            block_offsets = np.array([offsets[i][dates[i][epoch]] for epoch in epochs])
+            window = band[out_epochs, first_row-row0:last_row-row0, col0:col1]
+            fill = (window == 0) & (block != 0)
+            window[fill] = (block + block_offsets[:, None, None])[fill]
+            band[out_epochs, first_row-row0:last_row-row0, col0:col1] = window
+        timeseries[:, row0:row1, :] = band
+    for h5f in h5fs:
+        h5f.close()
+    h5f_out.close()
+
+    return offsets
@@ -1,4 +1,5 @@
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import os
 from pathlib import Path
@@ -12,9 +13,10 @@ from osgeo import gdal, ogr, osr
 gdal.UseExceptions()
 from pyproj import Transformer
 import rasterio
-from shapely.geometry import Polygon
+from shapely.geometry import Polygon, box
 from shapely.ops import transform
 import shapely.wkt
+from volcsarvatory.cache import load_json_cache, update_json_cache
 
 
 def get_projection(img_path: Union[Path, str]) -> Union[str, None]:
@@ -170,6 +172,78 @@ def get_geotiff_bbox(geotiff_path: Union[str, os.PathLike], dst_epsg: str=None)
     ])
 
 
+def read_tiff_metadata(geotiff_path: Union[str, os.PathLike]) -> Dict:
+    """
+    Takes: A string path or posix path to a GeoTiff
+
+    Returns: Dictionary with the EPSG (string), bounds (xmin, ymin, xmax, ymax), resolution, no-data value
+             (as in get_no_data_val) and data type of the GeoTiff, read from its header in a single open
+    """
+    with rasterio.open(geotiff_path) as dataset:
+        dtype = dataset.dtypes[0]
+        epsg = dataset.crs.to_epsg() if dataset.crs else None
+        if np.issubdtype(np.dtype(dtype), np.floating) or np.issubdtype(np.dtype(dtype), np.complexfloating):
+            no_data_val = np.nan if dataset.nodata is None else dataset.nodata
+        else:
+            no_data_val = 0
+        return {
+            'epsg': None if epsg is None else str(epsg),
+            'bounds': tuple(dataset.bounds),
+            'res': dataset.res[0],
+            'nodata': no_data_val,
+            'dtype': dtype,
+        }
+
+
+def scan_tiffs(
+    tiff_paths: List[Union[str, os.PathLike]],
+    max_workers: int=8,
+    index_file: Optional[Union[str, os.PathLike]]=None
+) -> gpd.GeoDataFrame:
+    """
+    Reads the metadata of several GeoTiffs concurrently, opening each file once
+
+    tiff_paths: list of paths to GeoTiffs
+    max_workers: maximum number of files read at the same time
+    index_file: (optional) JSON sidecar index where the metadata is cached. Entries are reused while the
+                path, modification time and size of the file match
+
+    Returns: GeoDataFrame with the columns 'tiff_path', 'EPSG', 'geometry' (bounding box), 'res', 'nodata' and 'dtype'
+    """
+    tiff_paths = list(tiff_paths)
+    index = dict() if index_file is None else load_json_cache(index_file)
+    stats = [Path(p).stat() for p in tiff_paths]
+    metadata = dict()
+    for p, stat in zip(tiff_paths, stats):
+        entry = index.get(str(Path(p).resolve()))
+        if entry is not None and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            metadata[str(p)] = entry['metadata']
+    missing = [p for p in tiff_paths if str(p) not in metadata]
+    missing_set = set(missing)
+    if len(missing) > 0:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for p, meta in zip(missing, executor.map(read_tiff_metadata, missing)):
+                metadata[str(p)] = meta
+        if index_file is not None:
+            entries = dict()
+            for p, stat in zip(tiff_paths, stats):
+                if p in missing_set:
+                    entries[str(Path(p).resolve())] = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'metadata': metadata[str(p)]}
+            update_json_cache(index_file, entries)
+
+    metas = [metadata[str(p)] for p in tiff_paths]
+    return gpd.GeoDataFrame(
+        {
+        'tiff_path': tiff_paths,
+        'EPSG': [meta['epsg'] for meta in metas],
+        'geometry': [box(*meta['bounds']) for meta in metas],
+        'res': [meta['res'] for meta in metas],
+        'nodata': [meta['nodata'] for meta in metas],
+        'dtype': [meta['dtype'] for meta in metas],
+        }
+    )
+
+
 def possible_wgs84_wkt(wkt: str) -> bool:
     """
     If WKT Polygon falls within the range of valid WGS84 coords,